@@ -0,0 +1,250 @@
+###############################################################################
+# Program: backup.py
+# Purpose: Online backup of registry.db while counters keep working. The
+# copy is made with the sqlite3 backup API a few pages at a time, sleeping
+# between steps so the source is only locked for one short step at a time.
+# The finished copy is checked with PRAGMA integrity_check before it
+# replaces anything, and only the newest --keep backups are kept.
+#
+# With --probe a second connection commits a small write the way a counter
+# would and measures how long each commit takes, first with no backup
+# running and then during the backup, so the cost of the backup on live
+# operations is part of the report.
+#
+# A commit from another connection makes SQLite restart the copy from the
+# first page; the number of restarts is reported. After --max-restarts
+# what happens depends on the journal mode. In WAL mode the rest is
+# copied in a single step, which reads a snapshot and blocks no one. In the
+# rollback journal modes a step holds the read lock that commits wait for,
+# so the steps are doubled instead and the copy starts over; once a step
+# covers the whole file commits wait for the copy, and a warning says so.
+# Larger --pages finish faster under heavy writes at the cost of longer
+# steps.
+#
+# Usage
+#
+# python backup.py --db ./registry.db --dir ./backups --pages 256 --keep 7
+# python backup.py --probe --max-restarts 20
+#
+#################################################################################
+
+
+import sqlite3
+import argparse
+import threading
+import time
+import glob
+import os
+import sys
+
+PREFIX = "registry-"
+SUFFIX = ".db"
+
+
+def backup_name(directory):
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    return os.path.join(directory, f"{PREFIX}{stamp}{SUFFIX}")
+
+
+class TooManyRestarts(Exception):
+    pass
+
+
+def run_backup(source_path, target_path, pages, sleep, max_restarts):
+    progress = {"steps": 0, "restarts": 0, "remaining": None, "total": 0,
+                "single_step": False, "pages": pages, "attempt_restarts": 0}
+
+    def report(status, remaining, total):
+        # a step that made no headway started over from the first page
+        if progress["remaining"] is not None and remaining >= progress["remaining"]:
+            progress["restarts"] += 1
+            progress["attempt_restarts"] += 1
+            if progress["attempt_restarts"] > max_restarts:
+                raise TooManyRestarts()
+        progress["steps"] += 1
+        progress["remaining"] = remaining
+        progress["total"] = total
+        if progress["steps"] % 50 == 0:
+            done = total - remaining
+            print(f"  {done}/{total} pages ({done / max(total, 1):.0%})",
+                  file=sys.stderr)
+        # the backup API only sleeps on SQLITE_BUSY, so yield here; the
+        # source lock is already released between steps
+        if remaining > 0:
+            time.sleep(sleep)
+
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(target_path)
+    page_size = source.execute('PRAGMA page_size;').fetchone()[0]
+    wal = source.execute('PRAGMA journal_mode;').fetchone()[0] == 'wal'
+    start = time.perf_counter()
+    try:
+        while True:
+            try:
+                source.backup(target, pages=progress["pages"],
+                              progress=report, sleep=sleep)
+                break
+            except TooManyRestarts:
+                pass
+            if wal:
+                progress["single_step"] = True
+                source.backup(target)
+                break
+            progress["pages"] *= 2
+            progress["remaining"] = None
+            progress["attempt_restarts"] = 0
+            print(f"  {max_restarts} restarts, steps grown to "
+                  f"{progress['pages']} pages", file=sys.stderr)
+            if progress["pages"] >= progress["total"] and not progress["single_step"]:
+                progress["single_step"] = True
+                print("  WARNING: a step now covers the whole file, commits "
+                      "wait until the copy is done", file=sys.stderr)
+    finally:
+        elapsed = time.perf_counter() - start
+        target.close()
+        source.close()
+    progress["seconds"] = elapsed
+    progress["bytes"] = progress["total"] * page_size
+    return progress
+
+
+def verify(path):
+    connection = sqlite3.connect(path)
+    try:
+        result = connection.execute('PRAGMA integrity_check;').fetchall()
+    finally:
+        connection.close()
+    return result == [("ok",)]
+
+
+def rotate(directory, keep):
+    backups = sorted(glob.glob(os.path.join(glob.escape(directory),
+                                            PREFIX + "*" + SUFFIX)))
+    removed = backups[:max(0, len(backups) - keep)]
+    for path in removed:
+        os.remove(path)
+    return removed
+
+
+PROBE_TABLE = "backupProbe"
+
+
+class LockProbe(threading.Thread):
+    # repeatedly commits a one row write the way a counter operation would,
+    # recording how long each commit took; taking the write lock alone is
+    # not enough, since RESERVED coexists with the SHARED lock of a backup
+    # step and only the commit has to wait for it
+
+    def __init__(self, path, interval):
+        super().__init__(daemon=True)
+        self.connection = sqlite3.connect(path, timeout=30,
+                                          check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.execute(
+            f'CREATE TABLE IF NOT EXISTS {PROBE_TABLE} (id int, ptime real, primary key (id));')
+        self.interval = interval
+        self.samples = []
+        self.running = threading.Event()
+        self.running.set()
+
+    def run(self):
+        while self.running.is_set():
+            start = time.perf_counter()
+            self.connection.execute('BEGIN IMMEDIATE;')
+            self.connection.execute(
+                f'INSERT OR REPLACE INTO {PROBE_TABLE} VALUES (1, ?);',
+                (time.time(),))
+            self.connection.execute('COMMIT;')
+            self.samples.append(time.perf_counter() - start)
+            time.sleep(self.interval)
+        self.connection.execute(f'DROP TABLE IF EXISTS {PROBE_TABLE};')
+        self.connection.close()
+
+    def stop(self):
+        self.running.clear()
+        self.join()
+        return self.samples
+
+
+def drop_probe_table(path):
+    # the copy was taken while the probe was writing
+    connection = sqlite3.connect(path)
+    connection.execute(f'DROP TABLE IF EXISTS {PROBE_TABLE};')
+    connection.commit()
+    connection.close()
+    return
+
+
+def summary(samples):
+    if len(samples) == 0:
+        return "no samples"
+    samples = sorted(samples)
+    p50 = samples[len(samples) // 2] * 1000
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000
+    return (f"{len(samples)} samples, p50 {p50:.2f}ms, p95 {p95:.2f}ms, "
+            f"max {samples[-1] * 1000:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Online registry backup")
+    parser.add_argument("--db", default="./registry.db")
+    parser.add_argument("--dir", default="./backups")
+    parser.add_argument("--pages", type=int, default=256,
+                        help="pages copied per step")
+    parser.add_argument("--sleep", type=float, default=0.005,
+                        help="seconds to yield between steps")
+    parser.add_argument("--keep", type=int, default=7)
+    parser.add_argument("--max-restarts", type=int, default=20,
+                        help="restarts before the rest is copied in one step")
+    parser.add_argument("--probe", action="store_true",
+                        help="measure write lock latency before and during")
+    parser.add_argument("--probe-seconds", type=float, default=2.0)
+    parser.add_argument("--probe-interval", type=float, default=0.005)
+    args = parser.parse_args()
+
+    os.makedirs(args.dir, exist_ok=True)
+    target = backup_name(args.dir)
+    partial = target + ".partial"
+
+    if args.probe:
+        probe = LockProbe(args.db, args.probe_interval)
+        probe.start()
+        time.sleep(args.probe_seconds)
+        baseline = list(probe.samples)
+        probe.samples.clear()
+
+    print(f"Backing up {args.db} to {target}")
+    progress = run_backup(args.db, partial, args.pages, args.sleep,
+                          args.max_restarts)
+
+    if args.probe:
+        during = probe.stop()
+        drop_probe_table(partial)
+
+    megabytes = progress["bytes"] / 1e6
+    print(f"Copied {progress['total']} pages ({megabytes:.1f}MB) in "
+          f"{progress['seconds']:.2f}s, {megabytes / max(progress['seconds'], 1e-9):.1f}MB/s, "
+          f"{progress['steps']} steps, {progress['restarts']} restarts")
+    if progress["single_step"]:
+        print(f"Finished in a single step after {args.max_restarts} restarts")
+    elif progress["pages"] != args.pages:
+        print(f"Steps grown to {progress['pages']} pages to keep up with writes")
+    if args.probe:
+        print(f"Write commit time without backup: {summary(baseline)}")
+        print(f"Write commit time during backup:  {summary(during)}")
+
+    start = time.perf_counter()
+    if not verify(partial):
+        os.remove(partial)
+        print("Integrity check FAILED, backup discarded")
+        return 1
+    os.replace(partial, target)
+    print(f"Integrity check ok in {time.perf_counter() - start:.2f}s")
+
+    for path in rotate(args.dir, args.keep):
+        print(f"Removed old backup {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,288 @@
+###############################################################################
+# Program: camera.py
+# Purpose: Automated ticket and demerit issuance from red light and speed
+# cameras. Detection records (plate, timestamp, violation code, location)
+# are read as CSV lines from a file or stdin. Timestamps with an offset are
+# converted to UTC and those without one are taken as UTC. Repeat reads of the same plate
+# and violation within --window seconds are dropped. The rest are batched:
+# each batch is loaded into a temporary table and resolved to the
+# registration valid on the day of the detection with a single join, then
+# the tickets and demerit notices of the whole batch are written in one
+# transaction. Notices for the same driver on the same day are merged
+# because demeritNotices allows one row per driver per day.
+#
+# After every batch the pipeline reports throughput, lag (the age of the
+# newest detection written) and backlog (lines read but not yet processed;
+# a backlog that keeps growing means the pipeline is not keeping up).
+#
+# Usage
+#
+# python camera.py ingest --db ./registry.db < reads.csv
+# python camera.py ingest --db ./registry.db reads.csv --batch 5000
+# python camera.py simulate --db ./registry.db --count 100000 > reads.csv
+#
+#################################################################################
+
+
+import sqlite3
+import argparse
+import datetime
+import threading
+import queue
+import random
+import time
+import sys
+
+import registry
+
+# code: (description, fine, demerit points)
+VIOLATIONS = {
+    "RL": ("ran a red light", 300, 3),
+    "SP1": ("speeding 1-20 over", 100, 2),
+    "SP2": ("speeding 21-40 over", 200, 3),
+    "SP3": ("speeding 41+ over", 400, 6),
+    "SB": ("school bus passing", 500, 6),
+}
+
+RESOLVE_QUERY = '''
+    SELECT id, regno, fname, lname FROM (
+    SELECT d.id, r.regno, r.fname, r.lname,
+    row_number() over (partition by d.id order by r.regdate desc) as rn
+    FROM temp.detections d JOIN registrations r
+    ON r.plate = d.plate AND r.regdate <= d.vdate AND r.expiry >= d.vdate
+    ) WHERE rn = 1;
+    '''
+
+
+def parse_detection(line):
+    # plate,timestamp,code,location with an ISO timestamp
+    fields = [field.strip() for field in line.split(",", 3)]
+    if len(fields) != 4 or fields[0] == "plate":
+        return None
+    plate, stamp, code, location = fields
+    if code not in VIOLATIONS:
+        return None
+    try:
+        seen = datetime.datetime.fromisoformat(stamp)
+    except ValueError:
+        return None
+    if seen.tzinfo is not None:
+        seen = seen.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (plate, seen, code, location)
+
+
+class Deduper:
+    # drops a read when the same plate and code was seen within the window
+
+    def __init__(self, window):
+        self.window = datetime.timedelta(seconds=window)
+        self.last_seen = {}
+        self.newest = None
+
+    def accept(self, detection):
+        plate, seen, code, location = detection
+        key = (plate, code)
+        previous = self.last_seen.get(key)
+        if previous is not None and abs(seen - previous) <= self.window:
+            return False
+        self.last_seen[key] = seen
+        if self.newest is None or seen > self.newest:
+            self.newest = seen
+        if len(self.last_seen) > 100000:
+            self.prune()
+        return True
+
+    def prune(self):
+        # keeps memory bounded to the reads inside the window
+        cutoff = self.newest - self.window
+        self.last_seen = {key: seen for key, seen in self.last_seen.items()
+                          if seen >= cutoff}
+
+
+class Pipeline:
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, timeout=30,
+                                          isolation_level=None)
+        self.connection.execute('PRAGMA foreign_keys=ON;')
+        self.integer_dates = registry.uses_integer_dates(self.connection)
+        self.connection.execute('''
+            create temp table detections (
+            id		int,
+            plate	char(7),
+            vdate	date,
+            primary key (id)
+            );''')
+        self.stats = {"read": 0, "duplicates": 0, "unmatched": 0,
+                      "tickets": 0, "notices": 0, "batches": 0}
+
+    def close(self):
+        self.connection.close()
+
+    def write_batch(self, batch):
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE;')
+        try:
+            cursor.execute('DELETE FROM temp.detections;')
+            cursor.executemany(
+                'INSERT INTO temp.detections VALUES (?,?,?);',
+                ((i, plate, registry.store_date(seen, self.integer_dates))
+                 for i, (plate, seen, code, location) in enumerate(batch)))
+            owners = {row[0]: row[1:] for row in cursor.execute(RESOLVE_QUERY)}
+
+            tno = cursor.execute(
+                'SELECT coalesce(max(tno), 0) FROM tickets;').fetchone()[0]
+            tickets = []
+            notices = []
+            for i, (plate, seen, code, location) in enumerate(batch):
+                if i not in owners:
+                    self.stats["unmatched"] += 1
+                    continue
+                regno, fname, lname = owners[i]
+                description, fine, points = VIOLATIONS[code]
+                tno += 1
+                vdate = registry.store_date(seen, self.integer_dates)
+                tickets.append((tno, regno, fine, f"{description} at {location}",
+                                vdate))
+                notices.append((vdate, fname, lname, points, description))
+            cursor.executemany('INSERT INTO tickets VALUES (?,?,?,?,?);', tickets)
+            cursor.executemany(
+                '''INSERT INTO demeritNotices VALUES (?,?,?,?,?)
+                ON CONFLICT (ddate, fname, lname) DO UPDATE SET
+                points = points + excluded.points,
+                desc = desc || '; ' || excluded.desc;''', notices)
+            cursor.execute('COMMIT;')
+        except BaseException:
+            cursor.execute('ROLLBACK;')
+            raise
+        self.stats["tickets"] += len(tickets)
+        self.stats["notices"] += len(notices)
+        self.stats["batches"] += 1
+        return
+
+
+def read_lines(stream, lines):
+    for line in stream:
+        lines.put(line)
+    lines.put(None)
+    return
+
+
+def ingest(path, stream, batch_size, max_wait, window):
+    # a reader thread feeds a queue so a quiet stream still flushes its
+    # partial batch after max_wait seconds
+    pipeline = Pipeline(path)
+    deduper = Deduper(window)
+    lines = queue.Queue(maxsize=batch_size * 4)
+    reader = threading.Thread(target=read_lines, args=(stream, lines),
+                              daemon=True)
+    reader.start()
+
+    stats = pipeline.stats
+    batch = []
+    started = time.perf_counter()
+    flushed = time.monotonic()
+    finished = False
+    while not finished:
+        try:
+            line = lines.get(timeout=max_wait)
+        except queue.Empty:
+            line = ""
+        if line is None:
+            finished = True
+        elif line != "":
+            detection = parse_detection(line)
+            if detection is not None:
+                stats["read"] += 1
+                if deduper.accept(detection):
+                    batch.append(detection)
+                else:
+                    stats["duplicates"] += 1
+
+        due = time.monotonic() - flushed >= max_wait
+        if len(batch) >= batch_size or (batch and (due or finished)):
+            pipeline.write_batch(batch)
+            newest = max(seen for plate, seen, code, location in batch)
+            now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+            lag = (now - newest).total_seconds()
+            elapsed = time.perf_counter() - started
+            print(f'Batch{stats["batches"]}; Read:{stats["read"]} '
+                  f'Duplicates:{stats["duplicates"]} Unmatched:{stats["unmatched"]} '
+                  f'Tickets:{stats["tickets"]} Rate:{stats["read"] / elapsed:.0f}/s '
+                  f'Lag:{lag:.1f}s Backlog:{lines.qsize()}', file=sys.stderr)
+            batch = []
+            flushed = time.monotonic()
+        elif due:
+            flushed = time.monotonic()
+
+    pipeline.close()
+    return stats
+
+
+def simulate(path, count, duplicate_rate, out):
+    # writes detections of registered plates, each timed inside the
+    # validity period of its registration and no later than now, so the
+    # lag reported on the simulated reads is never negative
+    connection = sqlite3.connect(path)
+    registrations = connection.execute(
+        'SELECT plate, regdate, expiry FROM registrations;').fetchall()
+    connection.close()
+    rng = random.Random(1)
+    codes = list(VIOLATIONS)
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    today = now.date()
+    previous = None
+    out.write("plate,timestamp,code,location\n")
+    for i in range(count):
+        if previous is not None and rng.random() < duplicate_rate:
+            detection = previous
+        else:
+            plate, regdate, expiry = rng.choice(registrations)
+            first = registry.load_date(regdate)
+            last = min(registry.load_date(expiry), today)
+            days = max(0, (last - first).days)
+            seen = datetime.datetime.combine(
+                first + datetime.timedelta(days=rng.randint(0, days)),
+                datetime.time(rng.randint(0, 23), rng.randint(0, 59)))
+            seen = min(seen, now)
+            detection = (plate, seen.isoformat(), rng.choice(codes),
+                         f"camera {rng.randint(1, 400)}")
+        out.write(",".join(detection) + "\n")
+        previous = detection
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Traffic camera pipeline")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("ingest", help="issue tickets from detections")
+    run.add_argument("input", nargs="?", help="CSV file, stdin when omitted")
+    run.add_argument("--db", default="./registry.db")
+    run.add_argument("--batch", type=int, default=2000)
+    run.add_argument("--max-wait", type=float, default=1.0,
+                     help="seconds before a partial batch is written")
+    run.add_argument("--window", type=float, default=300,
+                     help="seconds within which repeat reads are dropped")
+    fake = commands.add_parser("simulate", help="write sample detections")
+    fake.add_argument("--db", default="./registry.db")
+    fake.add_argument("--count", type=int, default=10000)
+    fake.add_argument("--duplicates", type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.command == "simulate":
+        simulate(args.db, args.count, args.duplicates, sys.stdout)
+        return 0
+    stream = open(args.input) if args.input else sys.stdin
+    try:
+        stats = ingest(args.db, stream, args.batch, args.max_wait, args.window)
+    finally:
+        if args.input:
+            stream.close()
+    print(f'Read {stats["read"]} detections, dropped {stats["duplicates"]} '
+          f'repeats, {stats["unmatched"]} without a valid registration, issued '
+          f'{stats["tickets"]} tickets in {stats["batches"]} batches')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,328 @@
+###############################################################################
+# Program: loadgen.py
+# Purpose: Concurrency load generator for registry.db. It builds a synthetic
+# dataset and then starts agent and officer worker processes that run a
+# weighted mix of the registry operations against it at the same time. The
+# operations are the real functions from registry.py; their prompts are
+# answered from a script and their output is discarded.
+#
+# Workers connect with busy_timeout 0 by default, so every SQLITE_BUSY comes
+# back to the worker. The worker rolls back, backs off and retries the whole
+# operation with the same inputs, counting the retries and the time lost to
+# them; an operation still busy after --max-retries is reported under "gave
+# up", apart from the errors. Pass
+# --busy-timeout to let SQLite wait internally instead, and --journal-mode to
+# compare journal modes.
+#
+# Usage
+#
+# python loadgen.py --agents 4 --officers 8 --duration 30
+# python loadgen.py --journal-mode wal --mix issue_ticket=5,find_owner=1
+#
+#################################################################################
+
+
+import multiprocessing
+import argparse
+import random
+import time
+import sqlite3
+import sys
+
+import registry
+
+AGENT_OPERATIONS = ["renew_vehicle", "process_payment", "process_bill",
+                    "get_driver_abstract"]
+OFFICER_OPERATIONS = ["issue_ticket", "find_owner"]
+DEFAULT_MIX = {"issue_ticket": 4, "find_owner": 1, "renew_vehicle": 3,
+               "process_payment": 3, "process_bill": 1,
+               "get_driver_abstract": 2}
+SURNAMES = ["Smith", "Brown", "Tremblay", "Martin", "Roy", "Gagnon", "Lee",
+            "Wilson", "Johnson", "Macdonald", "Taylor", "Campbell"]
+MAKES = [("Tesla", "Model 3"), ("Mercedes", "Benz"), ("Ford", "Focus"),
+         ("Honda", "Civic"), ("Toyota", "Corolla"), ("Mazda", "Three")]
+COLORS = ["black", "red", "white", "blue", "grey", "green"]
+
+
+def letters(i):
+    # names may only hold letters, so numbers are spelled in base 26
+    name = ""
+    while True:
+        name = chr(ord("a") + i % 26) + name
+        i = i // 26
+        if i == 0:
+            return name.capitalize()
+
+
+def random_date(rng, first_year, last_year):
+    return f"{rng.randint(first_year, last_year)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+
+
+def generate_dataset(path, persons, vehicles, tickets, journal_mode, seed,
+                     integer_dates=False):
+    rng = random.Random(seed)
+    registry.connect(path)
+    registry.drop_tables()
+    registry.define_tables()
+    registry.insert_data()
+    cursor = registry.cursor
+
+    people = [(letters(i), SURNAMES[i % len(SURNAMES)]) for i in range(persons)]
+    cursor.executemany(
+        "INSERT INTO persons VALUES (?,?,?,?,?,?)",
+        ((fname, lname, random_date(rng, 1940, 2000), "Edmonton, CA",
+          "Edmonton, CA", "780-555-0100") for fname, lname in people))
+
+    cursor.executemany(
+        "INSERT INTO vehicles VALUES (?,?,?,?,?)",
+        ((f"v{i}",) + rng.choice(MAKES) + (rng.randint(1995, 2020),
+                                           rng.choice(COLORS))
+         for i in range(vehicles)))
+
+    regnos = []
+    rows = []
+    for i in range(vehicles):
+        owner = rng.choice(people)
+        regnos.append(1000 + i)
+        rows.append((1000 + i, random_date(rng, 2015, 2018),
+                     random_date(rng, 2018, 2021), f"p{i:06d}", f"v{i}") + owner)
+    cursor.executemany("INSERT INTO registrations VALUES (?,?,?,?,?,?,?)", rows)
+
+    cursor.executemany(
+        "INSERT INTO tickets VALUES (?,?,?,?,?)",
+        ((1000 + i, rng.choice(regnos), rng.choice([50, 100, 150, 300]),
+          "speeding", random_date(rng, 2016, 2019)) for i in range(tickets)))
+    cursor.executemany(
+        "INSERT OR IGNORE INTO demeritNotices VALUES (?,?,?,?,?)",
+        ((random_date(rng, 2016, 2019),) + rng.choice(people) +
+         (rng.randint(1, 6), "speeding") for i in range(tickets)))
+
+    registry.index_all_persons()
+    registry.connection.commit()
+    if integer_dates:
+        registry.migrate_dates(True)
+    # the mode only sticks once the pragma's result row has been read
+    cursor.execute(f"PRAGMA journal_mode={journal_mode};")
+    cursor.fetchall()
+    registry.connection.close()
+    return
+
+
+class Script:
+    # answers the input() prompts of one operation in order
+
+    def __init__(self, answers):
+        self.answers = iter(answers)
+
+    def __call__(self, prompt=""):
+        return next(self.answers)
+
+
+def pick(rng, sql):
+    registry.cursor.execute(sql)
+    row = registry.cursor.fetchone()
+    return row if row is not None else ()
+
+
+def answers_for(operation, rng):
+    # chooses existing rows at random and returns the prompt answers
+    if operation == "issue_ticket":
+        regno = pick(rng, "SELECT regno FROM registrations ORDER BY random() LIMIT 1;")
+        return [str(regno[0]), "", "speeding", str(rng.choice([50, 100, 200])),
+                "exit"]
+    if operation == "find_owner":
+        vehicle = pick(rng, "SELECT make, model, color FROM vehicles ORDER BY random() LIMIT 1;")
+        return [vehicle[0], vehicle[1], "", vehicle[2], ""]
+    if operation == "renew_vehicle":
+        regno = pick(rng, "SELECT regno FROM registrations ORDER BY random() LIMIT 1;")
+        return [str(regno[0])]
+    if operation == "process_payment":
+        ticket = pick(rng, "SELECT tno, fine FROM tickets WHERE fine > 0 ORDER BY random() LIMIT 1;")
+        return [str(ticket[0]), str(max(1, ticket[1] // 2))]
+    if operation == "process_bill":
+        current = pick(rng, '''SELECT vin, fname, lname FROM registrations
+                       ORDER BY random() LIMIT 1;''')
+        registry.cursor.execute(
+            'Select fname, lname from registrations WHERE vin=? ORDER BY expiry DESC;',
+            (current[0],))
+        owner = registry.cursor.fetchone()
+        buyer = pick(rng, "SELECT fname, lname FROM persons ORDER BY random() LIMIT 1;")
+        return [current[0], owner[0], owner[1], buyer[0], buyer[1]]
+    if operation == "get_driver_abstract":
+        person = pick(rng, "SELECT fname, lname FROM registrations ORDER BY random() LIMIT 1;")
+        return [person[0], person[1], "y"]
+    raise ValueError(f"unknown operation {operation}")
+
+
+def is_busy(error):
+    message = str(error)
+    return "locked" in message or "busy" in message
+
+
+def worker(role, number, args, start, results):
+    # a crashed worker still reports, so main does not wait for it forever
+    try:
+        stats = run_operations(role, number, args, start)
+    except BaseException:
+        results.put(None)
+        raise
+    results.put(stats)
+    return
+
+
+def run_operations(role, number, args, start):
+    rng = random.Random(args.seed * 1000 + number)
+    registry.connect(args.db)
+    registry.cursor.execute(f"PRAGMA busy_timeout={args.busy_timeout};")
+    registry.print = lambda *values, **kwargs: None
+    registry.budget_state["role"] = role
+    operations = AGENT_OPERATIONS if role == "a" else OFFICER_OPERATIONS
+    weights = [args.mix.get(operation, 0) for operation in operations]
+    stats = {operation: {"latencies": [], "retries": 0, "lock_wait": 0.0,
+                         "errors": 0, "busy_failures": 0}
+             for operation in operations}
+    if sum(weights) == 0:
+        return stats
+
+    start.wait()
+    deadline = time.monotonic() + args.duration
+    while time.monotonic() < deadline:
+        operation = rng.choices(operations, weights)[0]
+        op = stats[operation]
+        # inputs are chosen before the clock starts and reused by every
+        # retry, so a retry repeats the same request
+        try:
+            answers = answers_for(operation, rng)
+        except sqlite3.OperationalError as error:
+            if not is_busy(error):
+                raise
+            continue
+        began = time.perf_counter()
+        for attempt in range(args.max_retries + 1):
+            tried = time.perf_counter()
+            try:
+                registry.input = Script(answers)
+                status = getattr(registry, operation)()
+                registry.connection.commit()
+                op["latencies"].append(time.perf_counter() - began)
+                # operations report a rejected request by returning -1
+                if status == -1:
+                    op["errors"] += 1
+                break
+            except sqlite3.OperationalError as error:
+                registry.connection.rollback()
+                if not is_busy(error):
+                    op["errors"] += 1
+                    break
+                backoff = min(0.1, 0.001 * 2 ** attempt) * rng.random()
+                time.sleep(backoff)
+                op["retries"] += 1
+                op["lock_wait"] += time.perf_counter() - tried
+            except sqlite3.Error:
+                # constraint failures; programming errors are not caught
+                registry.connection.rollback()
+                op["errors"] += 1
+                break
+            except registry.QueryTooBroad:
+                op["errors"] += 1
+                break
+        else:
+            op["busy_failures"] += 1
+
+    registry.connection.close()
+    return stats
+
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def report(all_stats, duration):
+    totals = {}
+    for stats in all_stats:
+        for operation, op in stats.items():
+            total = totals.setdefault(operation, {
+                "latencies": [], "retries": 0, "lock_wait": 0.0,
+                "errors": 0, "busy_failures": 0})
+            total["latencies"].extend(op["latencies"])
+            for key in ("retries", "lock_wait", "errors", "busy_failures"):
+                total[key] += op[key]
+
+    print(f'\n{"operation":<20}{"ops":>8}{"ops/s":>9}{"p50 ms":>9}{"p95 ms":>9}'
+          f'{"p99 ms":>9}{"max ms":>9}{"retries":>9}{"wait s":>9}{"errors":>8}{"gave up":>9}')
+    for operation, total in sorted(totals.items()):
+        latencies = sorted(total["latencies"])
+        print(f'{operation:<20}{len(latencies):>8}{len(latencies) / duration:>9.1f}'
+              f'{percentile(latencies, 0.50) * 1000:>9.2f}'
+              f'{percentile(latencies, 0.95) * 1000:>9.2f}'
+              f'{percentile(latencies, 0.99) * 1000:>9.2f}'
+              f'{(latencies[-1] if latencies else 0) * 1000:>9.2f}'
+              f'{total["retries"]:>9}{total["lock_wait"]:>9.2f}'
+              f'{total["errors"]:>8}{total["busy_failures"]:>9}')
+    return totals
+
+
+def parse_mix(text):
+    mix = dict(DEFAULT_MIX)
+    if text:
+        for part in text.split(","):
+            operation, weight = part.split("=")
+            if operation not in DEFAULT_MIX:
+                raise argparse.ArgumentTypeError(f"unknown operation {operation}")
+            mix[operation] = int(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Registry concurrency load test")
+    parser.add_argument("--db", default="./loadtest.db")
+    parser.add_argument("--agents", type=int, default=2)
+    parser.add_argument("--officers", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--persons", type=int, default=5000)
+    parser.add_argument("--vehicles", type=int, default=10000)
+    parser.add_argument("--tickets", type=int, default=10000)
+    parser.add_argument("--journal-mode", default="delete")
+    parser.add_argument("--integer-dates", action="store_true",
+                        help="store dates as day numbers")
+    parser.add_argument("--busy-timeout", type=int, default=0,
+                        help="milliseconds SQLite waits before SQLITE_BUSY")
+    parser.add_argument("--max-retries", type=int, default=50)
+    parser.add_argument("--mix", type=parse_mix, default=dict(DEFAULT_MIX),
+                        help="weights like issue_ticket=5,renew_vehicle=2")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"Generating dataset in {args.db}")
+    generate_dataset(args.db, args.persons, args.vehicles, args.tickets,
+                     args.journal_mode, args.seed, args.integer_dates)
+
+    context = multiprocessing.get_context("spawn")
+    start = context.Event()
+    results = context.Queue()
+    workers = []
+    roles = ["a"] * args.agents + ["o"] * args.officers
+    for number, role in enumerate(roles):
+        process = context.Process(target=worker,
+                                  args=(role, number, args, start, results))
+        process.start()
+        workers.append(process)
+
+    print(f"Running {args.agents} agents and {args.officers} officers for "
+          f"{args.duration}s, journal_mode={args.journal_mode} "
+          f"busy_timeout={args.busy_timeout}ms")
+    start.set()
+    all_stats = [results.get() for process in workers]
+    for process in workers:
+        process.join()
+    if None in all_stats:
+        print(f"{all_stats.count(None)} workers failed, see the tracebacks above")
+        return 1
+    report(all_stats, args.duration)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+###############################################################################
+# Program: maintenance.py
+# Purpose: Background maintenance for registry.db. The scheduler wakes up
+# every --interval seconds and runs a task only when it is due:
+#
+# analyze     PRAGMA optimize, or a full ANALYZE on the first run, once
+#             --analyze-rows rows have changed; the row count comes from the
+#             generations the registry triggers keep in tableVersions
+# vacuum      PRAGMA incremental_vacuum in small steps once the free pages
+#             exceed --vacuum-bytes (needs auto_vacuum=INCREMENTAL, see
+#             --setup)
+# checkpoint  a PASSIVE WAL checkpoint once the WAL exceeds --wal-bytes and
+#             something was written since the last checkpoint, and a
+#             TRUNCATE checkpoint whenever the database is idle with a WAL
+#
+# The database is idle when PRAGMA data_version has not moved for
+# --idle-seconds, which means no other connection has committed. Heavy work
+# waits for idle periods unless a threshold is far exceeded. Every task runs
+# with a short busy timeout, so it gives up and retries on the next wake-up
+# instead of making a counter wait. Time spent and space reclaimed are
+# reported for each task that runs.
+#
+# Usage
+#
+# python maintenance.py --db ./registry.db --setup
+# python maintenance.py --db ./registry.db --interval 30
+# python maintenance.py --db ./registry.db --once
+#
+#################################################################################
+
+
+import sqlite3
+import argparse
+import os
+import time
+import sys
+
+
+class Scheduler:
+
+    def __init__(self, path, args):
+        self.path = path
+        self.args = args
+        self.connection = sqlite3.connect(path, isolation_level=None,
+                                          timeout=args.busy_ms / 1000)
+        self.connection.execute('PRAGMA analysis_limit=400;')
+        self.page_size = self.pragma('page_size')
+        self.data_version = self.pragma('data_version')
+        self.last_write = time.monotonic()
+        self.analyzed_at = None
+        self.analyzed_rows = self.row_changes()
+        # data_version when the last checkpoint ran; a PASSIVE checkpoint
+        # does not shrink the WAL, so its size cannot tell whether anything
+        # was written since
+        self.checkpointed_version = None
+
+    def close(self):
+        self.connection.close()
+
+    def pragma(self, name):
+        return self.connection.execute(f'PRAGMA {name};').fetchone()[0]
+
+    def row_changes(self):
+        # rows written so far, as counted by the tableVersions triggers
+        try:
+            return self.connection.execute(
+                'SELECT coalesce(sum(gen), 0) FROM tableVersions;').fetchone()[0]
+        except sqlite3.OperationalError:
+            return 0
+
+    def wal_size(self):
+        wal = self.path + "-wal"
+        return os.path.getsize(wal) if os.path.exists(wal) else 0
+
+    def idle(self):
+        version = self.pragma('data_version')
+        if version != self.data_version:
+            self.data_version = version
+            self.last_write = time.monotonic()
+        return time.monotonic() - self.last_write >= self.args.idle_seconds
+
+    def run_task(self, name, task):
+        start = time.perf_counter()
+        try:
+            detail = task()
+        except sqlite3.OperationalError as error:
+            print(f"{name}: skipped ({error})")
+            return False
+        print(f"{name}: {time.perf_counter() - start:.3f}s, {detail}")
+        return True
+
+    def analyze(self):
+        changed = self.row_changes() - self.analyzed_rows
+        if self.analyzed_at is None:
+            self.connection.execute('ANALYZE;')
+        else:
+            self.connection.execute('PRAGMA optimize;')
+        self.analyzed_at = time.monotonic()
+        self.analyzed_rows = self.row_changes()
+        return f"{changed} rows changed since the last run"
+
+    def vacuum(self):
+        # small steps, each its own transaction, so writers get in between
+        before = self.pragma('freelist_count')
+        remaining = before
+        while remaining > 0:
+            self.connection.execute(
+                f'PRAGMA incremental_vacuum({self.args.vacuum_pages});').fetchall()
+            now = self.pragma('freelist_count')
+            if now >= remaining:
+                break
+            remaining = now
+        reclaimed = (before - remaining) * self.page_size
+        return f"reclaimed {reclaimed / 1e6:.2f}MB, {remaining} free pages left"
+
+    def checkpoint(self, mode):
+        before = self.wal_size()
+        busy, log, done = self.connection.execute(
+            f'PRAGMA wal_checkpoint({mode});').fetchone()
+        after = self.wal_size()
+        self.checkpointed_version = self.pragma('data_version')
+        return (f"{mode.lower()}, {done}/{log} frames copied"
+                f"{' (readers active)' if busy else ''}, "
+                f"WAL {before / 1e6:.2f}MB -> {after / 1e6:.2f}MB")
+
+    def tick(self, force=False):
+        idle = force or self.idle()
+        args = self.args
+
+        changed = self.row_changes() - self.analyzed_rows
+        if force or self.analyzed_at is None and idle or \
+                changed >= args.analyze_rows and (idle or changed >= 10 * args.analyze_rows):
+            self.run_task("analyze", self.analyze)
+
+        free_bytes = self.pragma('freelist_count') * self.page_size
+        if self.pragma('auto_vacuum') == 2 and free_bytes > 0 and (
+                force or free_bytes >= args.vacuum_bytes and idle):
+            self.run_task("vacuum", self.vacuum)
+
+        if self.pragma('journal_mode') == 'wal':
+            wal = self.wal_size()
+            if idle and wal > 0:
+                self.run_task("checkpoint", lambda: self.checkpoint("TRUNCATE"))
+            elif wal >= args.wal_bytes and \
+                    self.pragma('data_version') != self.checkpointed_version:
+                self.run_task("checkpoint", lambda: self.checkpoint("PASSIVE"))
+        return
+
+
+def setup(path):
+    # auto_vacuum can only be switched by rebuilding the file, so this runs
+    # once while the registry is offline
+    connection = sqlite3.connect(path, isolation_level=None)
+    start = time.perf_counter()
+    connection.execute('PRAGMA auto_vacuum=INCREMENTAL;')
+    connection.execute('VACUUM;')
+    mode = connection.execute('PRAGMA auto_vacuum;').fetchone()[0]
+    connection.close()
+    print(f"auto_vacuum={mode} after a {time.perf_counter() - start:.2f}s rebuild")
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Registry maintenance scheduler")
+    parser.add_argument("--db", default="./registry.db")
+    parser.add_argument("--setup", action="store_true",
+                        help="enable incremental vacuum (rebuilds the file)")
+    parser.add_argument("--once", action="store_true",
+                        help="run every task once and exit")
+    parser.add_argument("--interval", type=float, default=30.0)
+    parser.add_argument("--idle-seconds", type=float, default=60.0)
+    parser.add_argument("--analyze-rows", type=int, default=10000)
+    parser.add_argument("--vacuum-bytes", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--vacuum-pages", type=int, default=256,
+                        help="pages freed per incremental vacuum step")
+    parser.add_argument("--wal-bytes", type=int, default=16 * 1024 * 1024)
+    parser.add_argument("--busy-ms", type=int, default=50,
+                        help="longest a task waits for a lock")
+    args = parser.parse_args()
+
+    if args.setup:
+        setup(args.db)
+        return 0
+
+    scheduler = Scheduler(args.db, args)
+    try:
+        if args.once:
+            scheduler.tick(force=True)
+            return 0
+        while True:
+            scheduler.tick()
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scheduler.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
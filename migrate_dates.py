@@ -0,0 +1,51 @@
+###############################################################################
+# Program: migrate_dates.py
+# Purpose: Converts the date columns of an existing registry database between
+# iso text and integer day numbers (days since 1970-01-01). The conversion
+# runs in one transaction and records the mode in PRAGMA user_version, which
+# registry.py reads on connect. Text dates SQLite cannot parse, like the
+# 2019-4-9 older prompts accepted, are normalized; values that are not dates
+# at all are left alone and counted. --vacuum rebuilds the file afterwards
+# so the space saved by the smaller rows and indexes is returned.
+#
+# Usage
+#
+# python migrate_dates.py --db ./registry.db integer --vacuum
+# python migrate_dates.py --db ./registry.db text
+#
+#################################################################################
+
+
+import argparse
+import os
+import time
+import sys
+
+import registry
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Registry date storage migration")
+    parser.add_argument("--db", default="./registry.db")
+    parser.add_argument("mode", choices=["integer", "text"])
+    parser.add_argument("--vacuum", action="store_true")
+    args = parser.parse_args()
+
+    before = os.path.getsize(args.db)
+    registry.connect(args.db)
+    start = time.perf_counter()
+    changed, skipped = registry.migrate_dates(args.mode == "integer")
+    print(f"Converted {changed} values to {args.mode} dates in "
+          f"{time.perf_counter() - start:.2f}s")
+    if skipped > 0:
+        print(f"WARNING: {skipped} values are not dates and were left as text")
+    if args.vacuum:
+        registry.cursor.execute('VACUUM;')
+    registry.connection.close()
+    after = os.path.getsize(args.db)
+    print(f"File size {before / 1e6:.1f}MB -> {after / 1e6:.1f}MB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
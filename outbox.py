@@ -0,0 +1,143 @@
+###############################################################################
+# Program: outbox.py
+# Purpose: Incremental change feed for downstream systems (insurers, courts,
+# the provincial data warehouse). Triggers defined in registry.py append
+# every insert, update and delete on persons, registrations, tickets,
+# payments and demeritNotices to the changeLog table with an increasing
+# seq. A consumer registers a name, pulls the changes after its checkpoint
+# in batches and acknowledges them; compaction deletes the entries every
+# consumer has acknowledged. A sync costs the number of changes since the
+# last one instead of a full dump.
+#
+# Each change is a dict of seq, table, op (i, u or d), key (the primary key
+# of the row before the change) and row (the row after it, None on delete).
+# Dates are published as yyyy-mm-dd text, also from databases that store
+# them as day numbers.
+#
+# Usage
+#
+# python outbox.py register warehouse
+# python outbox.py pull warehouse --batch 500 --ack
+# python outbox.py compact
+#
+#################################################################################
+
+
+import sqlite3
+import argparse
+import json
+import sys
+
+
+def connect(path):
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA foreign_keys=ON;')
+    return connection
+
+
+def register_consumer(connection, name, from_start=True):
+    # a new consumer starts at the oldest retained change, or at the current
+    # end of the log when it already has a full copy
+    seq = 0
+    if not from_start:
+        seq = connection.execute(
+            'SELECT coalesce(max(seq), 0) FROM changeLog;').fetchone()[0]
+    connection.execute(
+        'INSERT OR IGNORE INTO outboxConsumers VALUES (?,?);', (name, seq))
+    connection.commit()
+    return checkpoint(connection, name)
+
+
+def checkpoint(connection, name):
+    row = connection.execute(
+        'SELECT seq FROM outboxConsumers WHERE name=?;', (name,)).fetchone()
+    if row is None:
+        raise KeyError(f"unknown consumer {name}")
+    return row[0]
+
+
+def read_changes(connection, after, batch_size=500):
+    rows = connection.execute(
+        '''SELECT seq, tname, op, pk, row FROM changeLog
+        WHERE seq > ? ORDER BY seq LIMIT ?;''', (after, batch_size))
+    return [{"seq": seq, "table": tname, "op": op, "key": json.loads(pk),
+             "row": None if row is None else json.loads(row)}
+            for seq, tname, op, pk, row in rows]
+
+
+def acknowledge(connection, name, seq):
+    # checkpoints only move forward
+    connection.execute(
+        'UPDATE outboxConsumers SET seq=max(seq, ?) WHERE name=?;', (seq, name))
+    connection.commit()
+    return
+
+
+def stream_changes(connection, name, batch_size=500):
+    # yields batches after the consumer's checkpoint; the checkpoint moves
+    # only when the caller acknowledges, so an interrupted sync resumes
+    # from the last acknowledged batch
+    after = checkpoint(connection, name)
+    while True:
+        batch = read_changes(connection, after, batch_size)
+        if len(batch) == 0:
+            return
+        yield batch
+        after = batch[-1]["seq"]
+
+
+def compact(connection):
+    # drops the entries every registered consumer has acknowledged
+    low = connection.execute(
+        'SELECT min(seq) FROM outboxConsumers;').fetchone()[0]
+    if low is None:
+        return 0
+    deleted = connection.execute(
+        'DELETE FROM changeLog WHERE seq <= ?;', (low,)).rowcount
+    connection.commit()
+    return deleted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Registry change feed")
+    parser.add_argument("--db", default="./registry.db")
+    commands = parser.add_subparsers(dest="command", required=True)
+    register = commands.add_parser("register", help="add a consumer")
+    register.add_argument("name")
+    register.add_argument("--from-now", action="store_true",
+                          help="skip the changes already in the log")
+    pull = commands.add_parser("pull", help="print changes as json lines")
+    pull.add_argument("name")
+    pull.add_argument("--batch", type=int, default=500)
+    pull.add_argument("--ack", action="store_true",
+                      help="acknowledge each batch once it is printed")
+    commands.add_parser("compact", help="delete acknowledged changes")
+    args = parser.parse_args()
+
+    connection = connect(args.db)
+    if args.command == "register":
+        seq = register_consumer(connection, args.name, not args.from_now)
+        print(f"Consumer {args.name} at seq {seq}")
+    elif args.command == "pull":
+        count = 0
+        try:
+            for batch in stream_changes(connection, args.name, args.batch):
+                for change in batch:
+                    print(json.dumps(change))
+                count += len(batch)
+                if args.ack:
+                    acknowledge(connection, args.name, batch[-1]["seq"])
+        except KeyError:
+            connection.close()
+            print(f"Unknown consumer {args.name}, register it first",
+                  file=sys.stderr)
+            return 1
+        print(f"{count} changes", file=sys.stderr)
+    elif args.command == "compact":
+        print(f"Deleted {compact(connection)} acknowledged changes")
+    connection.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,361 @@
+###############################################################################
+# Program: plate_index.py
+# Purpose: Offline plate lookups for patrol units. The exporter compiles the
+# current registration of every plate, joined with its vehicle, into a
+# compact sorted binary file. The lookup side opens that file with mmap and
+# binary searches it, so nothing is loaded up front and a lookup touches
+# only a handful of pages. Daily refreshes are shipped as small delta files
+# holding the changed and removed plates only. Each delta records the base
+# it was built against, and deltas left over from an older base (after a
+# crash or a partial sync) are ignored rather than applied to a new one.
+#
+# File layout (all integers little endian)
+#
+# header    magic, version, kind (base or delta), record count,
+#           regno index offset, string table offset, created time (ns),
+#           base (the created time of the base a delta applies to; a base
+#           holds its own)
+# records   fixed width, sorted by plate: plate, regno, year and string
+#           table offsets for fname, lname, make, model and color
+# regnos    (regno, record number) pairs sorted by regno
+# strings   length prefixed utf-8 strings, each stored once
+#
+# Usage
+#
+# python plate_index.py export registry.db plates.idx
+# python plate_index.py delta registry.db plates.idx
+# python plate_index.py lookup plates.idx jko128
+# python plate_index.py regno plates.idx 303
+#
+#################################################################################
+
+
+import sqlite3
+import struct
+import mmap
+import glob
+import heapq
+import os
+import time
+import sys
+import argparse
+
+MAGIC = b"PLIX"
+VERSION = 2
+BASE = 0
+DELTA = 1
+
+HEADER = struct.Struct("<4sHHIQQQQ")
+RECORD = struct.Struct("<8s7I")
+REGNO = struct.Struct("<II")
+PLATE_WIDTH = 8
+# regno of a delta record that removes the plate from the index
+TOMBSTONE = 0xFFFFFFFF
+
+CURRENT_QUERY = '''
+    SELECT plate, regno, year, fname, lname, make, model, color FROM (
+    SELECT r.plate, r.regno, v.year, r.fname, r.lname, v.make, v.model, v.color,
+    row_number() over (partition by r.plate
+                       order by r.expiry desc, r.regno desc) as rn
+    FROM registrations r JOIN vehicles v ON v.vin = r.vin
+    ) WHERE rn = 1 ORDER BY plate;
+    '''
+
+
+def encode_plate(plate):
+    raw = plate.strip().encode("ascii")
+    if len(raw) > PLATE_WIDTH:
+        raise ValueError(f"plate longer than {PLATE_WIDTH} characters: {plate}")
+    return raw.ljust(PLATE_WIDTH, b"\0")
+
+
+def current_registrations(db_path):
+    # rows of (plate, regno, year, fname, lname, make, model, color) by plate
+    connection = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        rows = connection.cursor()
+        rows.execute(CURRENT_QUERY)
+        for row in rows:
+            yield row
+    finally:
+        connection.close()
+
+
+def write_index(path, rows, kind=BASE, base=None):
+    strings = {}
+    string_table = bytearray()
+
+    def string_offset(value):
+        value = "" if value is None else str(value)
+        if value not in strings:
+            raw = value.encode("utf-8")[:255]
+            strings[value] = len(string_table)
+            string_table.append(len(raw))
+            string_table.extend(raw)
+        return strings[value]
+
+    # written beside the live file and swapped in whole, so a reader that
+    # has the old file mapped keeps its pages and no reader sees a half
+    # written one
+    regnos = []
+    count = 0
+    partial = path + ".partial"
+    with open(partial, "wb") as out:
+        out.write(b"\0" * HEADER.size)
+        for plate, regno, year, fname, lname, make, model, color in rows:
+            out.write(RECORD.pack(
+                encode_plate(plate), regno, year or 0, string_offset(fname),
+                string_offset(lname), string_offset(make),
+                string_offset(model), string_offset(color)))
+            if regno != TOMBSTONE:
+                regnos.append((regno, count))
+            count += 1
+
+        regno_offset = out.tell()
+        regnos.sort()
+        for pair in regnos:
+            out.write(REGNO.pack(*pair))
+        strings_offset = out.tell()
+        out.write(string_table)
+
+        created = time.time_ns()
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, VERSION, kind, count, regno_offset,
+                              strings_offset, created,
+                              created if base is None else base))
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(partial, path)
+    return count
+
+
+def delta_paths(path):
+    paths = glob.glob(glob.escape(path) + ".d*")
+    numbered = [p for p in paths if p[len(path) + 2:].isdigit()]
+    return sorted(numbered, key=lambda p: int(p[len(path) + 2:]))
+
+
+class IndexFile:
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.kind, self.count, self.regno_offset,
+         self.strings_offset, self.created, self.base) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a plate index")
+
+    def close(self):
+        self.map.close()
+
+    def plate_at(self, i):
+        offset = HEADER.size + i * RECORD.size
+        return self.map[offset:offset + PLATE_WIDTH]
+
+    def string(self, offset):
+        start = self.strings_offset + offset
+        length = self.map[start]
+        return self.map[start + 1:start + 1 + length].decode("utf-8")
+
+    def record(self, i):
+        values = RECORD.unpack_from(self.map, HEADER.size + i * RECORD.size)
+        plate, regno, year = values[0], values[1], values[2]
+        if regno == TOMBSTONE:
+            return None
+        fname, lname, make, model, color = (self.string(o) for o in values[3:])
+        return {"plate": plate.rstrip(b"\0").decode("ascii"), "regno": regno,
+                "fname": fname, "lname": lname, "make": make, "model": model,
+                "year": year, "color": color}
+
+    def find_plate(self, key):
+        # index of the record for key, or -1
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self.plate_at(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.count and self.plate_at(low) == key:
+            return low
+        return -1
+
+    def find_regno(self, regno):
+        low, high = 0, (self.strings_offset - self.regno_offset) // REGNO.size
+        while low < high:
+            mid = (low + high) // 2
+            if REGNO.unpack_from(self.map, self.regno_offset + mid * REGNO.size)[0] < regno:
+                low = mid + 1
+            else:
+                high = mid
+        offset = self.regno_offset + low * REGNO.size
+        if offset < self.strings_offset:
+            found, i = REGNO.unpack_from(self.map, offset)
+            if found == regno:
+                return i
+        return -1
+
+    def keys(self, rank):
+        for i in range(self.count):
+            yield self.plate_at(i), rank, i
+
+
+class PlateIndex:
+    # a base file plus its deltas; newer deltas shadow older files
+
+    def __init__(self, path):
+        base = IndexFile(path)
+        self.files = [base]
+        self.ignored = []
+        for delta in delta_paths(path):
+            f = IndexFile(delta)
+            if f.kind == DELTA and f.base == base.created:
+                self.files.append(f)
+            else:
+                f.close()
+                self.ignored.append(delta)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+    def lookup_plate(self, plate):
+        key = encode_plate(plate)
+        for f in reversed(self.files):
+            i = f.find_plate(key)
+            if i != -1:
+                return f.record(i)
+        return None
+
+    def lookup_regno(self, regno):
+        for f in reversed(self.files):
+            i = f.find_regno(regno)
+            if i == -1:
+                continue
+            record = f.record(i)
+            # the plate may have moved to another registration in a later file
+            if record is not None and self.lookup_plate(record["plate"]) == record:
+                return record
+        return None
+
+    def merged(self):
+        # (plate key, record) for every live plate in plate order, streamed
+        # as a merge of the sorted files so memory stays flat
+        streams = [f.keys(-rank) for rank, f in enumerate(self.files)]
+        last = None
+        for key, rank, i in heapq.merge(*streams):
+            if key == last:
+                continue
+            last = key
+            record = self.files[-rank].record(i)
+            if record is not None:
+                yield key, record
+
+
+def as_row(record):
+    return (record["plate"], record["regno"], record["year"], record["fname"],
+            record["lname"], record["make"], record["model"], record["color"])
+
+
+def normalize_row(row):
+    plate, regno, year, fname, lname, make, model, color = row
+    strings = ("" if v is None else str(v)[:255]
+               for v in (fname, lname, make, model, color))
+    return (plate.strip(), regno, year or 0, *strings)
+
+
+def export_base(db_path, path):
+    # a new base supersedes all of the old deltas; they go first so a reader
+    # never sees them on top of it (and would ignore them if it did)
+    for delta in delta_paths(path):
+        os.remove(delta)
+    return write_index(path, current_registrations(db_path), BASE)
+
+
+def export_delta(db_path, path):
+    # merge the sorted database rows against the shipped index and keep only
+    # the plates that were added, changed or removed
+    index = PlateIndex(path)
+    try:
+        shipped = index.merged()
+        changes = []
+        old = next(shipped, None)
+        for row in current_registrations(db_path):
+            key = encode_plate(row[0])
+            while old is not None and old[0] < key:
+                changes.append((old[1]["plate"], TOMBSTONE, 0, "", "", "", "", ""))
+                old = next(shipped, None)
+            if old is not None and old[0] == key:
+                if as_row(old[1]) != normalize_row(row):
+                    changes.append(row)
+                old = next(shipped, None)
+            else:
+                changes.append(row)
+        while old is not None:
+            changes.append((old[1]["plate"], TOMBSTONE, 0, "", "", "", "", ""))
+            old = next(shipped, None)
+        base = index.files[0].created
+    finally:
+        index.close()
+
+    if len(changes) == 0:
+        return None, 0
+    # numbered after every delta on disk, ignored ones included, so none of
+    # them is overwritten
+    existing = delta_paths(path)
+    number = int(existing[-1][len(path) + 2:]) + 1 if existing else 1
+    delta = f"{path}.d{number}"
+    write_index(delta, changes, DELTA, base)
+    return delta, len(changes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline plate index")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="write a new base index")
+    export.add_argument("db")
+    export.add_argument("index")
+    delta = commands.add_parser("delta", help="write a delta against the index")
+    delta.add_argument("db")
+    delta.add_argument("index")
+    lookup = commands.add_parser("lookup", help="find the owner of a plate")
+    lookup.add_argument("index")
+    lookup.add_argument("plate")
+    regno = commands.add_parser("regno", help="find a registration number")
+    regno.add_argument("index")
+    regno.add_argument("regno", type=int)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        start = time.perf_counter()
+        count = export_base(args.db, args.index)
+        print(f"Exported {count} plates in {time.perf_counter() - start:.2f}s")
+    elif args.command == "delta":
+        path, count = export_delta(args.db, args.index)
+        if path is None:
+            print("No changes since the last export")
+        else:
+            print(f"Wrote {count} changes to {path}")
+    else:
+        start = time.perf_counter()
+        index = PlateIndex(args.index)
+        for delta in index.ignored:
+            print(f"Ignored {delta}, built against another base", file=sys.stderr)
+        if args.command == "lookup":
+            record = index.lookup_plate(args.plate)
+        else:
+            record = index.lookup_regno(args.regno)
+        elapsed = (time.perf_counter() - start) * 1000
+        index.close()
+        if record is None:
+            print("Plate not found")
+            return 1
+        print(f'Plate:{record["plate"]} Regno:{record["regno"]} '
+              f'Owner:{record["fname"]} {record["lname"]} Make:{record["make"]} '
+              f'Model:{record["model"]} Year:{record["year"]} '
+              f'Color:{record["color"]} ({elapsed:.3f}ms)')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
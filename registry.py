@@ -19,6 +19,7 @@
 # d - Process a bill of Sale       j - View Marriages
 # e - Process a ticket payment     k - View Vehicle Registrations
 # f - Get a drivers abstract       l - View Ticket Payments
+#                                  n - Find duplicate persons
 #
 # Police Officer Operations
 #
@@ -33,10 +34,62 @@ import datetime
 from datetime import date
 import time
 import re
+import hashlib
+import hmac
+import secrets
+from collections import OrderedDict
 
 connection = None
 cursor = None
 
+# dates are stored as iso text unless the database was created or migrated
+# with integer dates, which are day numbers counted from EPOCH; the mode is
+# the INTEGER_DATES bit of PRAGMA user_version
+INTEGER_DATES = 1
+EPOCH = date(1970, 1, 1)
+# julian day of EPOCH, for conversions inside SQL
+EPOCH_JULIAN = 2440587.5
+date_mode = {"integer": False}
+# build new databases with integer dates
+INTEGER_DATE_STORAGE = False
+DATE_COLUMNS = {
+    "persons": ("bdate",),
+    "births": ("regdate",),
+    "marriages": ("regdate",),
+    "registrations": ("regdate", "expiry"),
+    "tickets": ("vdate",),
+    "payments": ("pdate",),
+    "demeritNotices": ("ddate",),
+}
+
+CACHE_SIZE = 128
+# rows held across all entries; larger results are not cached at all
+CACHE_ROWS = 20000
+CACHE_MAX_RESULT = 2000
+query_cache = OrderedDict()
+cache_stats = {"hits": 0, "misses": 0, "invalidations": 0, "uncached": 0}
+cache_state = {"data_version": None, "total_changes": None, "gens": {},
+               "rows": 0}
+
+# per-role limits for a single query: wall clock seconds and VM steps
+QUERY_BUDGETS = {
+    "a": {"seconds": 5.0, "steps": 50000000},
+    "o": {"seconds": 1.0, "steps": 5000000},
+}
+PROGRESS_INTERVAL = 1000
+budget_state = {"role": "a"}
+budget_stats = {}
+
+
+class QueryTooBroad(Exception):
+    pass
+
+PBKDF2_ITERATIONS = 200000
+HASH_PREFIX = "pbkdf2_sha256"
+# validated sessions by token; a hit needs neither the hash nor a query
+SESSION_TTL = 15 * 60
+sessions = {}
+
 
 def connect(path):
     global connection, cursor
@@ -45,10 +98,148 @@ def connect(path):
     cursor = connection.cursor()
     cursor.execute(' PRAGMA foreign_keys=ON; ')
     connection.commit()
+    date_mode["integer"] = uses_integer_dates(connection)
 
     return
 
 
+def uses_integer_dates(conn):
+    version = conn.execute('PRAGMA user_version;').fetchone()[0]
+    return version & INTEGER_DATES != 0
+
+
+def load_date(value):
+    # day number or iso text from the database to a date
+    if isinstance(value, int):
+        return EPOCH + datetime.timedelta(days=value)
+    if isinstance(value, str):
+        return date.fromisoformat(value)
+    return value
+
+
+def store_date(value, integer=None):
+    # date, datetime or iso text to the form the database stores
+    if integer is None:
+        integer = date_mode["integer"]
+    if isinstance(value, str):
+        # the same format the prompts validate, which allows 2019-4-9
+        value = datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    elif isinstance(value, datetime.datetime):
+        value = value.date()
+    if integer:
+        return (value - EPOCH).days
+    return value.isoformat()
+
+
+def add_year(value):
+    # same result as date(value, '+1 year') in SQLite
+    try:
+        return value.replace(year=value.year + 1)
+    except ValueError:
+        return date(value.year + 1, 3, 1)
+
+
+class DateField:
+    # stored as the raw value from the row and replaced by a date on first read
+    def __init__(self, slot):
+        self.slot = slot
+
+    def __get__(self, record, owner):
+        if record is None:
+            return self
+        value = getattr(record, self.slot)
+        if isinstance(value, (str, int)):
+            value = load_date(value)
+            setattr(record, self.slot, value)
+        return value
+
+
+class Record:
+    __slots__ = ()
+    columns = ()
+    slot_names = {}
+
+    def __init__(self, **values):
+        for column, value in values.items():
+            setattr(self, self.slot_names[column], value)
+
+    def __repr__(self):
+        values = []
+        for column in self.columns:
+            if hasattr(self, self.slot_names[column]):
+                values.append(f"{column}={getattr(self, column)!r}")
+        return f"{type(self).__name__}({', '.join(values)})"
+
+
+def record_class(name, columns, date_columns=()):
+    slot_names = {column: "_" + column if column in date_columns else column
+                  for column in columns}
+    namespace = {"__slots__": tuple(slot_names.values()),
+                 "columns": columns, "slot_names": slot_names}
+    for column in date_columns:
+        namespace[column] = DateField(slot_names[column])
+    return type(name, (Record,), namespace)
+
+
+Person = record_class(
+    "Person", ("fname", "lname", "bdate", "bplace", "address", "phone"),
+    ("bdate",))
+User = record_class(
+    "User", ("uid", "pwd", "utype", "fname", "lname", "city"))
+Birth = record_class(
+    "Birth", ("regno", "fname", "lname", "regdate", "regplace", "gender",
+              "f_fname", "f_lname", "m_fname", "m_lname"), ("regdate",))
+Marriage = record_class(
+    "Marriage", ("regno", "regdate", "regplace", "p1_fname", "p1_lname",
+                 "p2_fname", "p2_lname"), ("regdate",))
+Vehicle = record_class(
+    "Vehicle", ("vin", "make", "model", "year", "color"))
+Registration = record_class(
+    "Registration", ("regno", "regdate", "expiry", "plate", "vin", "fname",
+                     "lname"), ("regdate", "expiry"))
+Ticket = record_class(
+    "Ticket", ("tno", "regno", "fine", "violation", "vdate"), ("vdate",))
+Payment = record_class(
+    "Payment", ("tno", "pdate", "amount"), ("pdate",))
+DemeritNotice = record_class(
+    "DemeritNotice", ("ddate", "fname", "lname", "points", "desc"), ("ddate",))
+
+
+TABLE_RECORDS = {"persons": Person, "users": User, "births": Birth,
+                 "marriages": Marriage, "vehicles": Vehicle,
+                 "registrations": Registration, "tickets": Ticket,
+                 "payments": Payment, "demeritNotices": DemeritNotice}
+
+
+def iso_dates(table, rows):
+    # rows of a whole table with day numbers shown as iso text
+    columns = TABLE_RECORDS[table].columns
+    positions = [columns.index(column) for column in DATE_COLUMNS.get(table, ())]
+    if not date_mode["integer"] or len(positions) == 0:
+        return rows
+    shown = []
+    for row in rows:
+        row = list(row)
+        for i in positions:
+            if isinstance(row[i], int):
+                row[i] = load_date(row[i]).isoformat()
+        shown.append(tuple(row))
+    return shown
+
+
+def records(record, sql, params=()):
+    # a cursor of its own so callers can run other queries while iterating
+    rows = connection.cursor()
+    rows.execute(sql, params)
+    names = [column[0] for column in rows.description]
+    rows.row_factory = lambda cur, row: record(**dict(zip(names, row)))
+    return rows
+
+
+def first_record(record, sql, params=()):
+    return next(records(record, sql, params), None)
+
+
 def drop_tables():
     global connection, cursor
 
@@ -61,7 +252,17 @@ def drop_tables():
     drop_persons = "DROP TABLE IF EXISTS persons; "
     drop_payments = "DROP TABLE IF EXISTS payments; "
     drop_users = "DROP TABLE IF EXISTS users; "
-
+    drop_personGrams = "DROP TABLE IF EXISTS personGrams; "
+    drop_personKeys = "DROP TABLE IF EXISTS personKeys; "
+    drop_tableVersions = "DROP TABLE IF EXISTS tableVersions; "
+    drop_outboxConsumers = "DROP TABLE IF EXISTS outboxConsumers; "
+    drop_changeLog = "DROP TABLE IF EXISTS changeLog; "
+
+    cursor.execute(drop_outboxConsumers)
+    cursor.execute(drop_changeLog)
+    cursor.execute(drop_tableVersions)
+    cursor.execute(drop_personGrams)
+    cursor.execute(drop_personKeys)
     cursor.execute(drop_demeritNotices)
     cursor.execute(drop_payments)
     cursor.execute(drop_tickets)
@@ -204,21 +405,231 @@ def define_tables():
   foreign key (fname,lname) references persons
   );
 
+  '''
+
+    # phonetic keys used to match misspelled names against persons
+    personKeys_query = '''
+  create table personKeys (
+  fname		char(12),
+  lname		char(12),
+  fkey		char(4),
+  lkey		char(4),
+  primary key (fname,lname),
+  foreign key (fname,lname) references persons
+  );
+  '''
+
+    # plate lookups (cameras, the offline plate index) by validity period
+    registrations_plate_index = '''
+  create index registrations_plate on registrations (plate, regdate);
+  '''
+
+    # range scans on expiry, cheapest when dates are stored as day numbers
+    registrations_expiry_index = '''
+  create index registrations_expiry on registrations (expiry);
+  '''
+
+    # per driver scans in date order (abstracts, suspension detection)
+    demeritNotices_person_index = '''
+  create index demeritNotices_person on demeritNotices (fname, lname, ddate, points);
+  '''
+
+    personKeys_index = '''
+  create index personKeys_lkey on personKeys (lkey, fkey);
+  '''
+
+    # name trigrams, one row per gram so candidates come from the index
+    personGrams_query = '''
+  create table personGrams (
+  gram		char(3),
+  fname		char(12),
+  lname		char(12),
+  primary key (gram,fname,lname),
+  foreign key (fname,lname) references persons
+  );
   '''
 
     cursor.execute(demeritNotices_query)
+    cursor.execute(demeritNotices_person_index)
     cursor.execute(tickets_query)
     cursor.execute(registrations_query)
+    cursor.execute(registrations_plate_index)
+    cursor.execute(registrations_expiry_index)
     cursor.execute(vehicles_query)
     cursor.execute(marriages_query)
     cursor.execute(births_query)
     cursor.execute(users_query)
     cursor.execute(payments_query)
     cursor.execute(persons_query)
+    cursor.execute(personKeys_query)
+    cursor.execute(personKeys_index)
+    cursor.execute(personGrams_query)
+    define_table_versions()
+    define_outbox()
 
     return
 
 
+CACHED_TABLES = ["persons", "users", "births", "marriages", "vehicles",
+                 "registrations", "tickets", "payments", "demeritNotices"]
+
+
+def define_table_versions():
+    # every write to a cached table bumps its generation, so readers in any
+    # process can tell which tables changed since a result was cached
+    cursor.execute('''
+  create table tableVersions (
+  tname		char(20),
+  gen		int,
+  primary key (tname)
+  );
+  ''')
+    for table in CACHED_TABLES:
+        cursor.execute(
+            "INSERT INTO tableVersions VALUES (?,0)", (table,))
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            cursor.execute(f'''
+  create trigger {table}_{event.lower()}_gen after {event} on {table}
+  begin
+  update tableVersions set gen = gen + 1 where tname = '{table}';
+  end;
+  ''')
+    clear_query_cache()
+    return
+
+
+# tables whose changes are published: (columns, primary key columns)
+OUTBOX_TABLES = {
+    "persons": (("fname", "lname", "bdate", "bplace", "address", "phone"),
+                ("fname", "lname")),
+    "registrations": (("regno", "regdate", "expiry", "plate", "vin", "fname",
+                       "lname"), ("regno",)),
+    "tickets": (("tno", "regno", "fine", "violation", "vdate"), ("tno",)),
+    "payments": (("tno", "pdate", "amount"), ("tno", "pdate")),
+    "demeritNotices": (("ddate", "fname", "lname", "points", "desc"),
+                       ("ddate", "fname", "lname")),
+}
+
+
+def define_outbox():
+    # seq is assigned inside the writing transaction and SQLite has a single
+    # writer, so committed changes always appear in seq order
+    cursor.execute('''
+  create table changeLog (
+  seq		integer primary key autoincrement,
+  tname		char(20),
+  op		char(1),
+  pk		text,
+  row		text,
+  ctime		text default current_timestamp
+  );
+  ''')
+    cursor.execute('''
+  create table outboxConsumers (
+  name		char(20),
+  seq		int,
+  primary key (name)
+  );
+  ''')
+
+    create_outbox_triggers()
+    return
+
+
+def create_outbox_triggers():
+    # dates are published as iso text whatever the storage mode, so the
+    # feed does not change when a database is migrated
+
+    def value(prefix, table, column):
+        if column not in DATE_COLUMNS.get(table, ()):
+            return f"{prefix}.{column}"
+        return (f"CASE WHEN typeof({prefix}.{column}) = 'integer' "
+                f"THEN date({prefix}.{column} + {EPOCH_JULIAN}) "
+                f"ELSE {prefix}.{column} END")
+
+    def json_row(prefix, table, columns):
+        pairs = ", ".join(f"'{column}', {value(prefix, table, column)}"
+                          for column in columns)
+        return f"json_object({pairs})"
+
+    for table, (columns, key) in OUTBOX_TABLES.items():
+        events = (("INSERT", "i", "NEW", json_row("NEW", table, columns)),
+                  ("UPDATE", "u", "OLD", json_row("NEW", table, columns)),
+                  ("DELETE", "d", "OLD", "NULL"))
+        for event, op, key_row, row in events:
+            cursor.execute(f'''
+  create trigger {table}_{event.lower()}_outbox after {event} on {table}
+  begin
+  insert into changeLog (tname, op, pk, row)
+  values ('{table}', '{op}', {json_row(key_row, table, key)}, {row});
+  end;
+  ''')
+    return
+
+
+def drop_outbox_triggers():
+    for table in OUTBOX_TABLES:
+        for event in ("insert", "update", "delete"):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {table}_{event}_outbox;")
+    return
+
+
+def migrate_dates(integer):
+    # converts every date column in place to day numbers (integer=True) or
+    # back to iso text; rows already in the target form are left alone. The
+    # values do not change, only their storage, so nothing is published to
+    # the outbox. The triggers are recreated afterwards, which also upgrades
+    # databases whose triggers predate iso dates in the feed. Triggers and
+    # data change in one transaction, so a failure leaves both as they were
+    # and no write from another connection slips in while the triggers are
+    # gone. Returns the values converted and the values left unparsed
+    changed = 0
+    skipped = 0
+    cursor.execute('BEGIN IMMEDIATE;')
+    try:
+        drop_outbox_triggers()
+        for table, columns in DATE_COLUMNS.items():
+            for column in columns:
+                # dates like 2019-4-9 from older prompts, which SQLite cannot
+                # parse, are normalized the way store_date reads them
+                loose = connection.cursor()
+                loose.execute(f'''SELECT rowid, {column} FROM {table}
+                WHERE typeof({column}) = 'text' AND julianday({column}) IS NULL;''')
+                for rowid, value in loose.fetchall():
+                    try:
+                        value = store_date(value, integer)
+                    except ValueError:
+                        skipped += 1
+                        continue
+                    cursor.execute(f'UPDATE {table} SET {column} = ? WHERE rowid = ?;',
+                                   (value, rowid))
+                    changed += 1
+                if integer:
+                    cursor.execute(f'''UPDATE {table}
+                    SET {column} = CAST(julianday({column}) - {EPOCH_JULIAN} AS INTEGER)
+                    WHERE typeof({column}) = 'text' AND julianday({column}) IS NOT NULL;''')
+                else:
+                    cursor.execute(f'''UPDATE {table}
+                    SET {column} = date({column} + {EPOCH_JULIAN})
+                    WHERE typeof({column}) = 'integer';''')
+                changed += cursor.rowcount
+        cursor.execute('PRAGMA user_version;')
+        version = cursor.fetchone()[0]
+        if integer:
+            version |= INTEGER_DATES
+        else:
+            version &= ~INTEGER_DATES
+        cursor.execute(f'PRAGMA user_version = {version};')
+        create_outbox_triggers()
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    date_mode["integer"] = integer
+    clear_query_cache()
+    return changed, skipped
+
+
 def insert_data():
     global connection, cursor
 
@@ -301,10 +712,134 @@ def insert_data():
     cursor.execute(insert_tickets)
     cursor.execute(insert_payments)
     cursor.execute(insert_demerits)
+    hash_passwords()
+    index_all_persons()
     connection.commit()
     return
 
 
+def normalize_query(sql):
+    return re.sub(r"\s+", " ", sql).strip().rstrip(";").strip()
+
+
+def query_tables(sql):
+    # every cached table named anywhere in the statement, which also covers
+    # comma joins and subqueries; a stray match only costs an extra
+    # invalidation
+    names = re.findall(r"\w+", sql)
+    lookup = {table.lower(): table for table in CACHED_TABLES}
+    return tuple(sorted({lookup[name.lower()] for name in names
+                         if name.lower() in lookup}))
+
+
+def refresh_table_gens():
+    # data_version moves on commits from other connections and total_changes
+    # on writes from this one; the generations are only re-read when either
+    # has moved since the last lookup
+    cursor.execute('PRAGMA data_version;')
+    data_version = cursor.fetchone()[0]
+    total_changes = connection.total_changes
+    if (data_version, total_changes) != (cache_state["data_version"],
+                                         cache_state["total_changes"]):
+        cursor.execute('SELECT tname, gen FROM tableVersions;')
+        cache_state["gens"] = dict(cursor.fetchall())
+        cache_state["data_version"] = data_version
+        cache_state["total_changes"] = total_changes
+    return cache_state["gens"]
+
+
+def cached_query(sql, params=(), operation=None):
+    sql = normalize_query(sql)
+    key = (sql, tuple(params))
+    tables = query_tables(sql)
+    gens = refresh_table_gens()
+    current = tuple(gens.get(table) for table in tables)
+
+    entry = query_cache.get(key)
+    if entry is not None:
+        if entry[0] == current:
+            query_cache.move_to_end(key)
+            cache_stats["hits"] += 1
+            return list(entry[1])
+        evict_query(key)
+        cache_stats["invalidations"] += 1
+
+    cache_stats["misses"] += 1
+    if operation is not None:
+        rows = budgeted_query(operation, sql, params)
+    else:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    if len(tables) == 0 or len(rows) > CACHE_MAX_RESULT:
+        cache_stats["uncached"] += 1
+        return list(rows)
+    query_cache[key] = (current, rows)
+    cache_state["rows"] += len(rows)
+    while len(query_cache) > CACHE_SIZE or cache_state["rows"] > CACHE_ROWS:
+        evict_query(next(iter(query_cache)))
+    return list(rows)
+
+
+def evict_query(key):
+    current, rows = query_cache.pop(key)
+    cache_state["rows"] -= len(rows)
+    return
+
+
+def clear_query_cache():
+    query_cache.clear()
+    cache_state["data_version"] = None
+    cache_state["total_changes"] = None
+    cache_state["rows"] = 0
+    return
+
+
+def cache_report():
+    lookups = cache_stats["hits"] + cache_stats["misses"]
+    ratio = cache_stats["hits"] / lookups if lookups > 0 else 0
+    print(f'\nQuery cache; Hits:{cache_stats["hits"]} Misses:{cache_stats["misses"]} '
+          f'Invalidations:{cache_stats["invalidations"]} Hit ratio:{ratio:.2%} '
+          f'Entries:{len(query_cache)}/{CACHE_SIZE} Rows:{cache_state["rows"]}/{CACHE_ROWS} '
+          f'Uncached:{cache_stats["uncached"]}')
+    return
+
+
+def budgeted_query(operation, sql, params=()):
+    # the progress handler runs every PROGRESS_INTERVAL VM instructions and
+    # aborts the statement once either limit of the current role is spent
+    budget = QUERY_BUDGETS[budget_state["role"]]
+    stats = budget_stats.setdefault(operation, {"runs": 0, "cancelled": 0})
+    stats["runs"] += 1
+    deadline = time.monotonic() + budget["seconds"]
+    progress = {"steps": 0, "cancelled": False}
+
+    def handler():
+        progress["steps"] += PROGRESS_INTERVAL
+        if progress["steps"] > budget["steps"] or time.monotonic() > deadline:
+            progress["cancelled"] = True
+            return 1
+        return 0
+
+    connection.set_progress_handler(handler, PROGRESS_INTERVAL)
+    try:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+    except sqlite3.OperationalError:
+        if progress["cancelled"]:
+            stats["cancelled"] += 1
+            raise QueryTooBroad(operation)
+        raise
+    finally:
+        connection.set_progress_handler(None, PROGRESS_INTERVAL)
+
+
+def budget_report():
+    for operation, stats in sorted(budget_stats.items()):
+        print(f'Query budget; Operation:{operation} Runs:{stats["runs"]} '
+              f'Cancelled:{stats["cancelled"]}')
+    return
+
+
 def get_username_from_user():
     username = input("Enter Username: ")
     return username
@@ -315,35 +850,154 @@ def get_password_from_user():
     return password
 
 
+def hash_password(password, salt=None, iterations=PBKDF2_ITERATIONS):
+    if salt is None:
+        salt = secrets.token_hex(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt.encode(),
+                                 iterations)
+    return f"{HASH_PREFIX}${iterations}${salt}${digest.hex()}"
+
+
+def is_hashed(stored):
+    return stored.startswith(HASH_PREFIX + "$")
+
+
+def check_password(stored, password):
+    if not is_hashed(stored):
+        return hmac.compare_digest(stored, password)
+    prefix, iterations, salt, digest = stored.split("$")
+    return hmac.compare_digest(
+        hash_password(password, salt, int(iterations)), stored)
+
+
+def hash_passwords():
+    # replaces plaintext passwords left from before hashing
+    users = connection.cursor()
+    users.execute('SELECT uid, pwd FROM users;')
+    for uid, pwd in users.fetchall():
+        if not is_hashed(pwd):
+            cursor.execute('UPDATE users SET pwd=? WHERE uid=?;',
+                           (hash_password(pwd), uid))
+    connection.commit()
+    return
+
+
+Session = record_class("Session", ("token", "uid", "utype", "city", "expires"))
+
+
+def open_session(username, password):
+    # checks the password once and returns a session, or None
+    if not (re.match("^[A-Za-z0-9_]*$", username) and re.match("^[A-Za-z0-9_]*$", password)):
+        return None
+    user = first_record(User, 'SELECT * FROM users WHERE uid=?;', (username,))
+    if user is None or not check_password(user.pwd, password):
+        return None
+    if not is_hashed(user.pwd):
+        cursor.execute('UPDATE users SET pwd=? WHERE uid=?;',
+                       (hash_password(password), user.uid))
+        connection.commit()
+
+    now = time.monotonic()
+    for token in [token for token, session in sessions.items()
+                  if session.expires <= now]:
+        del sessions[token]
+    session = Session(token=secrets.token_urlsafe(32), uid=user.uid,
+                      utype=user.utype, city=user.city,
+                      expires=now + SESSION_TTL)
+    sessions[session.token] = session
+    return session
+
+
+def resume_session(token):
+    session = sessions.get(token)
+    if session is None:
+        return None
+    if session.expires <= time.monotonic():
+        del sessions[token]
+        return None
+    return session
+
+
+def revoke_session(token):
+    sessions.pop(token, None)
+    return
+
+
+def route_session(token):
+    # the role check runs on every request, cached session or not
+    session = resume_session(token)
+    if session is None:
+        return -1
+    budget_state["role"] = session.utype
+    if session.utype == "a":
+        agent_menu(session)
+    elif session.utype == "o":
+        officer_menu(session)
+    else:
+        return -1
+    return 1
+
+
+def leave_session(token):
+    # leaving a menu logs out; a suspended session can be resumed with its
+    # token, which is only shown then
+    choice = input("Log out? (y = Yes, s = Suspend and show a resume token): ")
+    if choice == "s":
+        print(f"Resume token (valid {SESSION_TTL // 60} minutes): {token}")
+    else:
+        revoke_session(token)
+        print("\n************* Logged out *************")
+    return
+
+
 def database_login():
 
+    # a suspended session skips the password check when it is resumed, until
+    # it expires
     login = "y"
 
     while login != "n":
-        login = input("Login? (y= Yes, n = No): ")
+        login = input("Login? (y= Yes, t = Resume with a session token, n = No): ")
         if login == "n":
             break
         elif login == "y":
             username = get_username_from_user()
             password = get_password_from_user()
-            if re.match("^[A-Za-z0-9_]*$", username) and re.match("^[A-Za-z0-9_]*$", password):
-                cursor.execute(
-                    'SELECT * FROM users WHERE uid=? and pwd=?;', (username, password))
-                result = cursor.fetchone()
-                if result is not None:
-                    print("\n************* Login Success! *************")
-                    if result[2] == "a":
-                        agent_menu(result)
-                        continue
-                    elif result[2] == "o":
-                        officer_menu(result)
-                        continue
+            session = open_session(username, password)
+            if session is not None:
+                print("\n************* Login Success! *************")
+                if route_session(session.token) == -1:
+                    revoke_session(session.token)
                     break
-                else:
-                    print("\nInvalid Login Credentials! ")
+                leave_session(session.token)
+            else:
+                print("\nInvalid Login Credentials! ")
+        elif login == "t":
+            token = input("Enter Session Token: ")
+            if route_session(token) == -1:
+                print("\nSession expired or not found! ")
+            else:
+                leave_session(token)
     return
 
 
+# columns shown by the View commands where not every column is
+LISTING_COLUMNS = {"users": "uid, utype, fname, lname, city"}
+
+
+def print_listing(table):
+    # the View commands of both menus, run under the budget of the role
+    columns = LISTING_COLUMNS.get(table, "*")
+    try:
+        rows = cached_query(f'SELECT {columns} from {table};',
+                            operation=f"view_{table}")
+    except QueryTooBroad:
+        print("\n************* Query too broad *************")
+        return -1
+    print("\n", iso_dates(table, rows))
+    return 1
+
+
 def officer_menu(result):
 
     command = "z"
@@ -354,14 +1008,19 @@ def officer_menu(result):
             issue_ticket()
             print("\n************* Ticket has now been issued *************")
         elif command == "b":
-            find_owner()
-            print("\n************* Car Owner has been found *************")
+            try:
+                b1 = find_owner()
+            except QueryTooBroad:
+                print("\n************* Query too broad, add more criteria *************")
+                continue
+            if b1 == 1:
+                print("\n************* Car Owner has been found *************")
+            elif b1 == -1:
+                print("\n************* No matching car found *************")
         elif command == "c":
-            cursor.execute('SELECT * from tickets;')
-            print("\n", cursor.fetchall())
+            print_listing("tickets")
         elif command == "d":
-            cursor.execute('SELECT * from registrations;')
-            print("\n", cursor.fetchall())
+            print_listing("registrations")
 
     return
 
@@ -374,16 +1033,15 @@ def issue_ticket():
             if inp.lower() == 'exit':
                 break
         regnum = inp
-        cursor.execute(
+        rows = cached_query(
             'SELECT vin,fname,lname FROM registrations WHERE regno=?', (regnum,))
-        out = cursor.fetchone()
-        if out == None:
+        if len(rows) == 0:
             print("Invalid Registration Num")
             continue
+        out = rows[0]
         vin = out[0]
-        cursor.execute(
-            'SELECT make,model,year,color FROM vehicles WHERE vin=?', (vin,))
-        out2 = cursor.fetchone()
+        out2 = cached_query(
+            'SELECT make,model,year,color FROM vehicles WHERE vin=?', (vin,))[0]
         out = out + out2
         print(out)
         inp1 = input(
@@ -407,7 +1065,7 @@ def issue_ticket():
         tno = cursor.fetchone()
         tno = tno[0] + 1
         cursor.execute("INSERT INTO tickets VALUES (?,?,?,?,?)",
-                       (tno, regnum, inp3, inp2, inp1))
+                       (tno, regnum, inp3, inp2, store_date(inp1)))
         connection.commit()
 
     return
@@ -415,47 +1073,50 @@ def issue_ticket():
 
 def find_owner():
 
-    def check_value(inp, string, type):
+    # criteria are bound as parameters; plate is a registration column, so
+    # vehicles are joined with their registrations and listed once per plate
+    criteria = ''
+    params = []
+
+    def check_value(inp, column):
+        nonlocal criteria
         if inp != '':
-            string += f' and {type}="{inp}"'
-        return string
-    command = 'SELECT count(distinct vin) FROM vehicles WHERE 1=1'
+            criteria += f' and {column}=?'
+            params.append(inp)
     make = input("Input Make(can enter nothing): ")
-    command = check_value(make, command, 'make')
+    check_value(make, 'v.make')
     model = input("Input Model: ")
-    command = check_value(model, command, 'model')
+    check_value(model, 'v.model')
     year = input("Input Year(yyyy-mm-dd): ")
-    command = check_value(year, command, 'year')
+    check_value(year, 'v.year')
     colour = input("Input Colour: ")
-    command = check_value(colour, command, 'color')
+    check_value(colour, 'v.color')
     plate = input("Input Plate: ")
-    command = check_value(plate, command, 'plate')
-    print(command)
-    cursor.execute(command)
-    count = cursor.fetchone()
+    check_value(plate, 'r.plate')
+    matches = ' FROM vehicles v JOIN registrations r ON r.vin = v.vin WHERE 1=1' + criteria
+    count = budgeted_query(
+        "find_owner", 'SELECT count(distinct v.vin)' + matches, params)[0]
     if count[0] >= 4:
-        command = 'SELECT make,model,year,color,vin FROM vehicles WHERE 1=1'
-        command = check_value(make, command, 'make')
-        command = check_value(model, command, 'model')
-        command = check_value(year, command, 'year')
-        command = check_value(colour, command, 'color')
-        cursor.execute(command)
-        out = cursor.fetchall()
-        command2 = 'select r.plate from registrations r where r.vin in (' + \
-            command + ')'
-        print(command2)
-        cursor.execute(command2)
-        plate = cursor.fetchall
-        for i, e in enumerate(plate):
-            out[i] = out[i] + e
-        print(out)
+        out = budgeted_query(
+            "find_owner", 'SELECT v.make, v.model, v.year, v.color, r.plate' +
+            matches + ' ORDER BY v.vin, r.regdate', params)
         for i, element in enumerate(out, start=1):
             print(
-                f'Car{i}; Make:{element[0]} Model:{element[1]} Year:{element[2]} Color:{element[3]}')
+                f'Car{i}; Make:{element[0]} Model:{element[1]} Year:{element[2]} Color:{element[3]} Plate:{element[4]}')
+    elif count[0] == 0:
+        return -1
     else:
-        pass
+        # few enough cars to show who owns each of them
+        out = budgeted_query(
+            "find_owner", 'SELECT v.make, v.model, v.year, v.color, r.plate, '
+            'r.regdate, r.expiry, r.fname, r.lname' +
+            matches + ' ORDER BY v.vin, r.regdate', params)
+        for i, element in enumerate(out, start=1):
+            print(
+                f'Car{i}; Make:{element[0]} Model:{element[1]} Year:{element[2]} Color:{element[3]} Plate:{element[4]} '
+                f'Registered:{load_date(element[5])} Expiry:{load_date(element[6])} Owner:{element[7]} {element[8]}')
 
-    return
+    return 1
 
 
 def print_agent_menu():
@@ -463,7 +1124,8 @@ def print_agent_menu():
     print("\nRegister birth = a , Register marriage = b , Renew vehicle registration = c")
     print("Process bill of sale = d, Process payment = e , Get a driver abstract= f")
     print("\nView users = g, View persons = h , View births= i, View marriages =j")
-    print("View vehicle registrations = k , View tickets = l , View Payments = m \n")
+    print("View vehicle registrations = k , View tickets = l , View Payments = m")
+    print("Find duplicate persons = n \n")
     return
 
 
@@ -512,26 +1174,23 @@ def agent_menu(result):
             elif f1 == -1:
                 print("\n************* Driver not found or Clean Record *************")
         elif command == "g":
-            cursor.execute('SELECT * from users;')
-            print("\n", cursor.fetchall())
+            print_listing("users")
         elif command == "h":
-            cursor.execute('SELECT * from persons;')
-            print("\n", cursor.fetchall())
+            print_listing("persons")
         elif command == "i":
-            cursor.execute('SELECT * from births;')
-            print("\n", cursor.fetchall())
+            print_listing("births")
         elif command == "j":
-            cursor.execute('SELECT * from marriages;')
-            print("\n", cursor.fetchall())
+            print_listing("marriages")
         elif command == "k":
-            cursor.execute('SELECT * from registrations;')
-            print("\n", cursor.fetchall())
+            print_listing("registrations")
         elif command == "l":
-            cursor.execute('SELECT * from tickets;')
-            print("\n", cursor.fetchall())
+            print_listing("tickets")
         elif command == "m":
-            cursor.execute('SELECT * from payments;')
-            print("\n", cursor.fetchall())
+            print_listing("payments")
+        elif command == "n":
+            n1 = list_duplicate_persons()
+            if n1 == -1:
+                print("\n************* No duplicate persons found *************")
         elif command != "x":
             print("\n************* Command not found *************")
 
@@ -696,27 +1355,199 @@ def get_names():
     return name
 
 
+SOUNDEX_CODES = {}
+for letters, code in (("BFPV", "1"), ("CGJKQSXZ", "2"), ("DT", "3"),
+                      ("L", "4"), ("MN", "5"), ("R", "6")):
+    for letter in letters:
+        SOUNDEX_CODES[letter] = code
+
+
+def soundex(name):
+    name = re.sub("[^A-Z]", "", name.upper())
+    if name == "":
+        return ""
+    key = name[0]
+    last = SOUNDEX_CODES.get(name[0], "")
+    for letter in name[1:]:
+        code = SOUNDEX_CODES.get(letter, "")
+        if code != "" and code != last:
+            key += code
+        # H and W do not separate two letters with the same code
+        if letter not in "HW":
+            last = code
+    return (key + "000")[:4]
+
+
+def name_grams(fname, lname):
+    padded = "  " + fname.lower() + " " + lname.lower() + " "
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+
+def name_similarity(name1, name2):
+    g1 = name_grams(name1[0], name1[1])
+    g2 = name_grams(name2[0], name2[1])
+    score = len(g1 & g2) / len(g1 | g2)
+    if soundex(name1[1]) == soundex(name2[1]) and soundex(name1[0]) == soundex(name2[0]):
+        score = (score + 1) / 2
+    return score
+
+
+def index_person(fname, lname):
+    cursor.execute("INSERT OR REPLACE INTO personKeys VALUES (?,?,?,?)",
+                   (fname, lname, soundex(fname), soundex(lname)))
+    cursor.executemany("INSERT OR IGNORE INTO personGrams VALUES (?,?,?)",
+                       [(gram, fname, lname) for gram in name_grams(fname, lname)])
+    return
+
+
+def index_all_persons():
+    cursor.execute('DELETE FROM personGrams;')
+    cursor.execute('DELETE FROM personKeys;')
+    people = connection.cursor()
+    people.execute('SELECT fname, lname FROM persons;')
+    for fname, lname in people:
+        index_person(fname, lname)
+    return
+
+
+def add_person(fname, lname, info):
+    # info=[bdate,bplace,address,phone] as returned by get_person_info
+    cursor.execute("INSERT INTO persons VALUES (?,?,?,?,?,?)",
+                   (fname, lname, store_date(info[0]), info[1], info[2], info[3]))
+    index_person(fname, lname)
+    return
+
+
+def similar_persons(fname, lname, limit=5, min_score=0.5):
+    grams = list(name_grams(fname, lname))
+    marks = ",".join("?" * len(grams))
+    cursor.execute(
+        f'''SELECT fname, lname FROM personGrams WHERE gram IN ({marks})
+        GROUP BY fname, lname HAVING count(*) >= ?
+        UNION
+        SELECT fname, lname FROM personKeys WHERE lkey=? and fkey=?;''',
+        grams + [len(grams) // 2, soundex(lname), soundex(fname)])
+    candidates = []
+    for row in cursor.fetchall():
+        if row[0] == fname and row[1] == lname:
+            continue
+        score = name_similarity((fname, lname), row)
+        if score >= min_score:
+            candidates.append((score, row[0], row[1]))
+    candidates.sort(reverse=True)
+    return candidates[:limit]
+
+
+def match_person(name):
+    # name=[fname,lname]; offers close matches when the exact name is unknown
+    cursor.execute(
+        'SELECT 1 FROM persons WHERE fname=? and lname=?;', (name[0], name[1]))
+    if cursor.fetchone() is not None:
+        return name
+    candidates = similar_persons(name[0], name[1])
+    if len(candidates) == 0:
+        return name
+    print(f"\n{name[0]} {name[1]} was not found. Did you mean:")
+    for i, candidate in enumerate(candidates, start=1):
+        print(f"{i} - {candidate[1]} {candidate[2]}")
+    while True:
+        choice = input("Enter a number or nothing to keep the name entered: ")
+        if choice == "":
+            return name
+        if choice.isdigit() and 1 <= int(choice) <= len(candidates):
+            candidate = candidates[int(choice) - 1]
+            return [candidate[1], candidate[2]]
+        print("\nInvalid Input! ")
+
+
+def find_duplicate_persons(min_score=0.6, max_block=500, window=50):
+    # names are compared only within blocks sharing the soundex key of the
+    # last name, then of the first name, so a misspelling on either side is
+    # still caught while the work is bounded by the block sizes instead of
+    # every pair of persons
+    parent = {}
+
+    def find(name):
+        while parent[name] != name:
+            parent[name] = parent[parent[name]]
+            name = parent[name]
+        return name
+
+    def compare(name1, name2):
+        if name1 in parent and name2 in parent and find(name1) == find(name2):
+            return
+        if name_similarity(name1, name2) >= min_score:
+            parent.setdefault(name1, name1)
+            parent.setdefault(name2, name2)
+            parent[find(name1)] = find(name2)
+
+    def compare_block(block):
+        if len(block) <= max_block:
+            for i in range(len(block)):
+                for j in range(i + 1, len(block)):
+                    compare(block[i], block[j])
+            return
+        # an oversized block is split into overlapping windows of names over
+        # two sort orders, spelled forwards and backwards, so a typo at
+        # either end of a name still leaves it near its match
+        for spelling in (lambda name: " ".join(name).lower(),
+                         lambda name: " ".join(name).lower()[::-1]):
+            ordered = sorted(block, key=spelling)
+            for i in range(len(ordered)):
+                for j in range(i + 1, min(i + window, len(ordered))):
+                    compare(ordered[i], ordered[j])
+
+    for key in ("lkey", "fkey"):
+        keys = connection.cursor()
+        keys.execute(
+            f'SELECT {key}, fname, lname FROM personKeys ORDER BY {key};')
+        block = []
+        block_key = None
+        for value, fname, lname in keys:
+            if value != block_key:
+                compare_block(block)
+                block = []
+                block_key = value
+            block.append((fname, lname))
+        compare_block(block)
+
+    clusters = {}
+    for name in parent:
+        clusters.setdefault(find(name), []).append(name)
+    return [sorted(cluster) for cluster in clusters.values()]
+
+
+def list_duplicate_persons():
+    clusters = find_duplicate_persons()
+    if len(clusters) == 0:
+        return -1
+    for i, cluster in enumerate(clusters, start=1):
+        names = ", ".join(f"{fname} {lname}" for fname, lname in cluster)
+        print(f"Cluster{i}; {names}")
+    return 1
+
+
 def register_birth(result):
 
     cursor.execute('Select count(*) from births;')
     count = cursor.fetchone()
     regno = count[0]+1
-    regdate = time.strftime("%Y-%m-%d")
-    regplace = result[5]
+    regdate = store_date(date.today())
+    regplace = result.city
 
     n = get_newborn_info()
+    n[5:7] = match_person(n[5:7])
+    n[7:9] = match_person(n[7:9])
 
-    cursor.execute(
-        'SELECT * FROM persons WHERE fname=? and lname=?;', (n[7], n[8]))
-    mother = cursor.fetchone()
+    mother = first_record(
+        Person, 'SELECT * FROM persons WHERE fname=? and lname=?;', (n[7], n[8]))
     if mother is not None:
-        address = mother[4]
-        phone = mother[5]
+        address = mother.address
+        phone = mother.phone
     else:
         print("\nPlease enter additional information for the newborn's mother")
         p1 = get_person_info()
-        cursor.execute("INSERT INTO persons VALUES (?,?,?,?,?,?)",
-                       (n[7], n[8], p1[0], p1[1], p1[2], p1[3]))
+        add_person(n[7], n[8], p1)
         address = p1[2]
         phone = p1[3]
 
@@ -726,11 +1557,9 @@ def register_birth(result):
     if father is None:
         print("\nPlease enter additional information for the newborn's father")
         p2 = get_person_info()
-        cursor.execute("INSERT INTO persons VALUES (?,?,?,?,?,?)",
-                       (n[5], n[6], p2[0], p2[1], p2[2], p2[3]))
+        add_person(n[5], n[6], p2)
 
-    cursor.execute("INSERT INTO persons VALUES (?,?,?,?,?,?)",
-                   (n[0], n[1], n[3], n[4], address, phone))
+    add_person(n[0], n[1], [n[3], n[4], address, phone])
 
     cursor.execute("INSERT INTO births VALUES (?,?,?,?,?,?,?,?,?,?)",
                    (regno, n[0], n[1], regdate, regplace, n[2], n[5], n[6], n[7], n[8]))
@@ -744,12 +1573,12 @@ def register_marriage(result):
     cursor.execute('Select max(regno) from marriages;')
     m_count = cursor.fetchone()
     m_regno = m_count[0]+1
-    m_regdate = time.strftime("%Y-%m-%d")
-    m_regplace = result[5]
+    m_regdate = store_date(date.today())
+    m_regplace = result.city
     print("\nPlease enter the name for partner 1")
-    name1 = get_names()
+    name1 = match_person(get_names())
     print("\nPlease enter the name for partner 2")
-    name2 = get_names()
+    name2 = match_person(get_names())
 
     cursor.execute(
         'SELECT * FROM persons WHERE fname=? and lname=?;', (name1[0], name1[1]))
@@ -757,8 +1586,7 @@ def register_marriage(result):
     if partner1 is None:
         print("\nPlease enter additional information for partner 1 ")
         p1 = get_person_info()
-        cursor.execute("INSERT INTO persons VALUES (?,?,?,?,?,?)",
-                       (name1[0], name1[1], p1[0], p1[1], p1[2], p1[3]))
+        add_person(name1[0], name1[1], p1)
 
     cursor.execute(
         'SELECT * FROM persons WHERE fname=? and lname=?;', (name2[0], name2[1]))
@@ -766,8 +1594,7 @@ def register_marriage(result):
     if partner2 is None:
         print("\nPlease enter additional information for partner 2 ")
         p2 = get_person_info()
-        cursor.execute("INSERT INTO persons VALUES (?,?,?,?,?,?)",
-                       (name2[0], name2[1], p2[0], p2[1], p2[2], p2[3]))
+        add_person(name2[0], name2[1], p2)
 
     cursor.execute("INSERT INTO marriages VALUES(?,?,?,?,?,?,?)", (m_regno,
                    m_regdate, m_regplace, name1[0], name1[1], name2[0], name2[1]))
@@ -779,22 +1606,22 @@ def renew_vehicle():
 
     v_regno = input("Please enter the vehicle registration number: ")
     if re.match("^[A-Za-z0-9_]*$", v_regno):
-        cursor.execute(
-            'SELECT * FROM registrations WHERE regno=?;', (v_regno,))
-        v_result = cursor.fetchone()
+        v_result = first_record(
+            Registration, 'SELECT * FROM registrations WHERE regno=?;', (v_regno,))
         if v_result is not None:
-            if v_result[2] == time.strftime("%Y-%m-%d"):
+            today = date.today()
+            if v_result.expiry == today:
                 print("\nExpring today! ")
                 cursor.execute(
-                    "UPDATE registrations SET expiry = date('now','+1 year') WHERE regno =?;", (v_regno,))
-            elif v_result[2] < time.strftime("%Y-%m-%d"):
+                    "UPDATE registrations SET expiry = ? WHERE regno =?;", (store_date(add_year(today)), v_regno))
+            elif v_result.expiry < today:
                 print("\nExpired! ")
                 cursor.execute(
-                    "UPDATE registrations SET expiry = date('now','+1 year') WHERE regno =?;", (v_regno,))
-            elif v_result[2] > time.strftime("%Y-%m-%d"):
+                    "UPDATE registrations SET expiry = ? WHERE regno =?;", (store_date(add_year(today)), v_regno))
+            elif v_result.expiry > today:
                 print("\nStill Valid! ")
                 cursor.execute(
-                    "UPDATE registrations SET expiry = date(expiry,'+1 year') WHERE regno =?;", (v_regno,))
+                    "UPDATE registrations SET expiry = ? WHERE regno =?;", (store_date(add_year(v_result.expiry)), v_regno))
             connection.commit()
             return 1
 
@@ -804,8 +1631,8 @@ def renew_vehicle():
 def process_bill():
 
     b_vin = input("\nPlease enter the vehicles vin: ")
-    cursor.execute('SELECT * from vehicles WHERE vin=?;', (b_vin,))
-    b_result = cursor.fetchone()
+    b_result = first_record(
+        Vehicle, 'SELECT * from vehicles WHERE vin=?;', (b_vin,))
     if b_result is None:
         print("\nVehicle Not Found! ")
         return -1
@@ -813,27 +1640,27 @@ def process_bill():
         print("\nPlease enter the name for current owner")
         name1 = get_names()
         print("\nPlease enter the name for new owner")
-        name2 = get_names()
-        cursor.execute(
-            'Select * from registrations WHERE vin=? ORDER BY expiry DESC;', (b_vin,))
-        r1_result = cursor.fetchone()
-        cursor.execute(
-            'SELECT * from persons WHERE fname=? AND lname=?', (name2[0], name2[1]))
-        r2_result = cursor.fetchone()
+        name2 = match_person(get_names())
+        r1_result = first_record(
+            Registration, 'Select * from registrations WHERE vin=? ORDER BY expiry DESC;', (b_vin,))
+        r2_result = first_record(
+            Person, 'SELECT * from persons WHERE fname=? AND lname=?', (name2[0], name2[1]))
         if r1_result is None or r2_result is None:
             print("Transfer cannot be made!")
             return -1
-        elif r1_result[5] != name1[0] or r1_result[6] != name1[1]:
+        elif r1_result.fname != name1[0] or r1_result.lname != name1[1]:
             print("\nTransfer cannot be made!")
             return -1
         else:
             cursor.execute('SELECT max(regno) FROM registrations')
-            new_regno = 425
+            new_regno = cursor.fetchone()[0] + 1
             print(r1_result)
+            today = date.today()
             cursor.execute('''
-      UPDATE registrations SET fname=? ,lname=?, regdate=date('now'), 
-      expiry = date('now','+1 year'), regno=? WHERE vin=? AND expiry=?
-      ''', (name2[0], name2[1], new_regno, b_vin, r1_result[2]))
+      UPDATE registrations SET fname=? ,lname=?, regdate=?, 
+      expiry = ?, regno=? WHERE regno=?
+      ''', (name2[0], name2[1], store_date(today), store_date(add_year(today)),
+            new_regno, r1_result.regno))
             connection.commit()
     return 1
 
@@ -841,14 +1668,13 @@ def process_bill():
 def process_payment():
     try:
         tno = input("Enter Valid Ticket number: ")
-        cursor.execute('SELECT * FROM tickets WHERE tno=?', (tno,))
-        out = cursor.fetchone()
+        out = first_record(Ticket, 'SELECT * FROM tickets WHERE tno=?', (tno,))
         if out == None:
             print("Invalid Ticket Number")
         else:
             print(out)
             d = date.today()
-            topay = out[2]
+            topay = out.fine
             print("reached")
             print(f'Payment Amount : {topay}')
             paid = input("How much do you want to pay?(type exit to exit) ")
@@ -859,10 +1685,10 @@ def process_payment():
                 if paid > topay:
                     pass
                 topay -= paid
-                inptup = (str(topay), str(out[0]),)
+                inptup = (str(topay), str(out.tno),)
 
                 cursor.execute('UPDATE tickets SET fine=? where tno=?', inptup)
-                inptup = (out[0], str(d), paid)
+                inptup = (out.tno, store_date(d), paid)
                 cursor.execute('Insert INTO payments VALUES (?,?,?)', inptup)
                 connection.commit()
     except TypeError:
@@ -877,17 +1703,16 @@ def get_driver_abstract():
         lname = input('Last Name: ').lower().capitalize()
 
         # Tickets Total
-        cursor.execute(
-            'SELECT regno FROM registrations WHERE fname=? and lname=? COLLATE NOCASE', (fname, lname))
-        out = cursor.fetchall()
-        if out == None:
+        regnos = [reg.regno for reg in records(
+            Registration, 'SELECT regno FROM registrations WHERE fname=? and lname=? COLLATE NOCASE', (fname, lname))]
+        if len(regnos) == 0:
             raise Exception
-        regnum = out[0]
+        regnum = regnos[0]
 
         ticketsT = 0
-        for element in out:
+        for element in regnos:
             cursor.execute(
-                'select count(tno) FROM tickets WHERE regno=?', element)
+                'select count(tno) FROM tickets WHERE regno=?', (element,))
             t = cursor.fetchone()
             ticketsT += t[0]
 
@@ -898,46 +1723,32 @@ def get_driver_abstract():
         else:
             ans = ans.lower()
             outList = []
-            cursor.execute(
-                'select tno,violation,vdate,fine,regno FROM tickets WHERE regno=?', regnum)
-            out = cursor.fetchall()
-            for element in out:
-                regno = str(element[4])
-                cursor.execute(
-                    'select vin FROM registrations WHERE regno=?', (regno,))
-                vin = cursor.fetchone()
-                cursor.execute(
-                    'select make,model FROM vehicles WHERE vin=?', (vin[0],))
-                car = cursor.fetchone()
-                fullDet = element + car
-                outList.append(fullDet)
+            for ticket in records(
+                    Ticket, 'select tno,violation,vdate,fine,regno FROM tickets WHERE regno=?', (regnum,)):
+                reg = first_record(
+                    Registration, 'select vin FROM registrations WHERE regno=?', (ticket.regno,))
+                car = first_record(
+                    Vehicle, 'select make,model FROM vehicles WHERE vin=?', (reg.vin,))
+                outList.append((ticket.tno, ticket.violation, str(ticket.vdate),
+                                ticket.fine, ticket.regno, car.make, car.model))
             res = outList
             print(res)
 
-        # Lifetime Demerits
-        cursor.execute(
-            'SELECT points FROM demeritNotices WHERE fname=? and lname=?', (fname, lname))
-        out = cursor.fetchall()
-        print(out)
-        demerits = 0
-        points = 0
-        for element in out:
-            points += element[0]
-            demerits += 1
-        print(f'{points}, {demerits}')
-
-        # Only last two Years Demerits
-        twoYrs = datetime.datetime.now() - datetime.timedelta(days=2*365)
-        cursor.execute(
-            'SELECT points FROM demeritNotices WHERE fname=? and lname=? and ddate>?', (fname, lname, twoYrs))
-        out = cursor.fetchall()
-        print(out)
-        demerits = 0
-        points = 0
-        for element in out:
-            points += element[0]
-            demerits += 1
-        print(f'{points}, {demerits}')
+        # Lifetime and last two Years Demerits in one pass over the notices
+        twoYrs = date.today() - datetime.timedelta(days=2*365)
+        lifetime = []
+        recent = []
+        for notice in records(
+                DemeritNotice, 'SELECT ddate,points FROM demeritNotices WHERE fname=? and lname=?', (fname, lname)):
+            lifetime.append(notice.points)
+            if notice.ddate > twoYrs:
+                recent.append(notice.points)
+        for out in (lifetime, recent):
+            print(out)
+            print(f'{sum(out)}, {len(out)}')
+    except sqlite3.OperationalError:
+        # a locked database is for the caller to retry, not a missing driver
+        raise
     except Exception:
         print("\nException Raised")
         return -1
@@ -953,7 +1764,11 @@ def main():
     drop_tables()
     define_tables()
     insert_data()
+    if INTEGER_DATE_STORAGE:
+        migrate_dates(True)
     database_login()
+    cache_report()
+    budget_report()
 
     connection.commit()
     connection.close()
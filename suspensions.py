@@ -0,0 +1,103 @@
+###############################################################################
+# Program: suspensions.py
+# Purpose: Finds every driver whose demerit points within a rolling window
+# (two years by default, as in the driver abstract) reached a suspension
+# threshold, and the date they reached it. It makes one pass over
+# demeritNotices in (fname, lname, ddate) order, which the
+# demeritNotices_person index provides without a sort. For each driver a
+# two-pointer window is kept as a queue: a notice enters at the back, and
+# notices older than the window leave at the front. Memory is bounded by the
+# notices one driver has inside one window, however large the table is.
+#
+# Each time a driver's total rises from below a threshold to at or above it
+# a crossing is written as a CSV line: fname,lname,threshold,date,points.
+#
+# Usage
+#
+# python suspensions.py --db ./registry.db
+# python suspensions.py --thresholds 8,15 --window-days 730 --since 2019-01-01
+#
+#################################################################################
+
+
+import sqlite3
+import argparse
+import collections
+import itertools
+import datetime
+import time
+import sys
+
+import registry
+
+
+def notices_by_driver(connection):
+    # (driver, notices) per driver; notices is a lazy stream of (ddate,
+    # points) over the shared cursor, so no driver's list is ever built
+    rows = connection.execute(
+        '''SELECT fname, lname, ddate, points FROM demeritNotices
+        ORDER BY fname, lname, ddate;''')
+    for driver, group in itertools.groupby(rows, key=lambda row: row[:2]):
+        yield driver, ((ddate, points) for fname, lname, ddate, points in group)
+
+
+def crossings(notices, window_days, thresholds):
+    # notices are (ddate, points) in date order for one driver
+    window = collections.deque()
+    total = 0
+    for ddate, points in notices:
+        # day numbers need no parsing when the database uses integer dates
+        if isinstance(ddate, int):
+            day = ddate
+        else:
+            day = datetime.date.fromisoformat(ddate).toordinal()
+        window.append((day, points))
+        while window[0][0] <= day - window_days:
+            total -= window.popleft()[1]
+        before = total
+        total += points
+        for threshold in thresholds:
+            if before < threshold <= total:
+                yield threshold, ddate, total
+
+
+def scan(connection, window_days, thresholds, since=None):
+    # yields (fname, lname, threshold, date, points) for every crossing
+    if since is not None:
+        since = registry.store_date(since,
+                                    registry.uses_integer_dates(connection))
+    for (fname, lname), notices in notices_by_driver(connection):
+        for threshold, ddate, total in crossings(notices, window_days,
+                                                  thresholds):
+            if since is None or ddate >= since:
+                yield fname, lname, threshold, registry.load_date(ddate), total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Suspension threshold scan")
+    parser.add_argument("--db", default="./registry.db")
+    parser.add_argument("--window-days", type=int, default=2 * 365)
+    parser.add_argument("--thresholds", default="15",
+                        help="comma separated point totals, like 8,15")
+    parser.add_argument("--since", help="only report crossings on or after yyyy-mm-dd")
+    args = parser.parse_args()
+    thresholds = sorted(int(t) for t in args.thresholds.split(","))
+
+    connection = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+    start = time.perf_counter()
+    count = 0
+    drivers = set()
+    print("fname,lname,threshold,date,points")
+    for fname, lname, threshold, ddate, total in scan(
+            connection, args.window_days, thresholds, args.since):
+        print(f"{fname},{lname},{threshold},{ddate},{total}")
+        drivers.add((fname, lname))
+        count += 1
+    connection.close()
+    print(f"{count} crossings by {len(drivers)} drivers in "
+          f"{time.perf_counter() - start:.2f}s", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())